@@ -13,9 +13,7 @@ import os
 import re
 import sys
 
-import plyvel
-
-from lib import BROWSER_PROFILE_DIRS
+from lib import BROWSER_PROFILE_DIRS, leveldb
 from lib.config import AppConf
 
 conf = AppConf()
@@ -25,8 +23,8 @@ conf = AppConf()
 FIREFOX_ONETAB = "browser-extension-data/extension@one-tab.com/storage.js"
 CHROME_ONETAB = "Local Storage/leveldb"
 
-# The plyvel docs recommend referencing LevelDB keys in the
-# binary form (which is how they are stored).
+# LevelDB keys are referenced in the binary form, which is how they are
+# stored.
 LEVELDB_ONETAB_KEY = (
     b"_chrome-extension://chphlpgkkbolifaimnlloiipkdnihall\x00\x01state"
 )
@@ -151,11 +149,8 @@ def read_storage(browser, username):
                 ...
             ]
         }
-    :raises plyvel._plyvel.IOError: Occurs if the file does not exist or the
-        database is locked by another process which has it open still, such as
-        a script or your actual browser.
-    :raises FileNotFoundError: If the Firefox file cannot be found to the given
-        username.
+    :raises FileNotFoundError: If the Chrome LevelDB directory or Firefox
+        file cannot be found for the given username.
     """
     browser_profile_dir = BROWSER_PROFILE_DIRS[browser]
     is_chrome_like = browser.startswith("Chrom")
@@ -166,8 +161,9 @@ def read_storage(browser, username):
     )
 
     if is_chrome_like:
-        db = plyvel.DB(in_path)
-        state_data_bytes = db.get(LEVELDB_ONETAB_KEY)
+        # The LevelDB files are read directly without taking a lock, so this
+        # works while the browser is open or on a copy of the directory.
+        state_data_bytes = leveldb.get(in_path, LEVELDB_ONETAB_KEY)
         data = parse_leveldb_bytes(state_data_bytes)
     else:
         with open(in_path) as f_in:
@@ -0,0 +1,441 @@
+"""
+Lib backup module.
+
+Back up the database while it is in use, and reclaim free space in it.
+
+A backup uses SQLite's online backup API to copy the main file, and any
+shard files, a small number of pages at a time. The database is only locked
+for reading while a step runs, so imports can carry on between steps. If
+another connection writes to a file during its backup, SQLite restarts the
+copy of that file from the start, so a backup always matches a single point
+in time. The processed JSON files can be added to the backup as a compressed
+tar file.
+
+Deleting pages, such as removing duplicates, leaves free pages in the file
+which a plain VACUUM reclaims only by rewriting the whole file under a lock.
+With auto_vacuum set to INCREMENTAL, free pages can instead be given back
+a few at a time with the incremental_vacuum pragma. Switching an existing
+database to that mode needs one full VACUUM.
+
+The database files should be switched to WAL journal mode once with
+--enable-wal, so that a backup never holds up writers. See backup_file.
+
+Reads and writes are kept under an I/O budget in MB per second, if one is
+set, by sleeping between steps. Progress and throughput are printed while
+each file is copied or compacted, and again when it is done.
+
+Usage:
+    $ python -m lib.backup [--processed] [--io-budget MB]
+    $ python -m lib.backup --enable-wal
+    $ python -m lib.backup --enable-incremental
+    $ python -m lib.backup --compact
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import tarfile
+import time
+
+from lib import shards
+from lib.config import AppConf
+
+
+conf = AppConf()
+
+# SQLite auto_vacuum mode for incremental vacuum.
+AUTO_VACUUM_INCREMENTAL = 2
+
+MB = 1024 * 1024
+
+# Times a backup may be restarted by writes before it holds a read lock to
+# finish. This only applies to files which are not in WAL mode.
+MAX_RESTARTS = 3
+
+# Least seconds between progress lines while a file is copied or compacted.
+PROGRESS_SECONDS = 1
+
+
+class IOBudget:
+    """
+    Limit the rate of I/O by sleeping once more bytes have been used than
+    the rate allows.
+    """
+
+    def __init__(self, mb_per_second=None):
+        """
+        Initialise instance of IOBudget class.
+
+        :param mb_per_second: Most MB to read or write per second. If None or
+            0, there is no limit.
+        """
+        self.bytes_per_second = (mb_per_second or 0) * MB
+        self.start = time.monotonic()
+        self.used = 0
+        self.last_progress = self.start
+
+    def spend(self, byte_count):
+        """
+        Record bytes used and sleep if the budget is used up.
+        """
+        self.used += byte_count
+        if self.bytes_per_second:
+            wait = self.used / self.bytes_per_second - self.elapsed()
+            if wait > 0:
+                time.sleep(wait)
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def progress(self, label, done, total):
+        """
+        Print the pages done so far and the throughput, if it has been
+        PROGRESS_SECONDS since the last time.
+        """
+        now = time.monotonic()
+        if now - self.last_progress < PROGRESS_SECONDS:
+            return
+        self.last_progress = now
+        self.report("{label}: {done:,d} of {total:,d} pages".format(
+            label=label, done=done, total=total))
+
+    def report(self, label):
+        """
+        Print the bytes used, the time taken and the throughput.
+        """
+        elapsed = self.elapsed()
+        print("{label}: {mb:,.1f} MB in {seconds:.1f} s ({rate:,.1f} MB/s)"
+              .format(label=label, mb=self.used / MB, seconds=elapsed,
+                      rate=self.used / MB / elapsed if elapsed else 0))
+
+
+def _page_size(db):
+    return db.execute("PRAGMA page_size").fetchone()[0]
+
+
+def _db_files():
+    """
+    Return the main database file and any shard files.
+
+    :return: list of 2-tuples of path and name relative to a backup
+        directory.
+    """
+    db_path = conf.get('db', 'path')
+    files = [(db_path, os.path.basename(db_path))]
+    for source_id in shards.sharded_source_ids():
+        path = shards.shard_path(source_id)
+        if os.path.exists(path):
+            files.append((path, os.path.join('shards',
+                                             os.path.basename(path))))
+
+    return files
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _begin_read(db):
+    """
+    Start a read transaction, so the connection sees one snapshot of the
+    file until it ends.
+    """
+    db.execute("BEGIN")
+    db.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+
+
+def _copy(src, dest, budget, step_pages, label, max_restarts=None):
+    """
+    Run the backup API from one connection to another.
+
+    Progress is printed after steps, at most once per PROGRESS_SECONDS.
+
+    :raises _TooManyRestarts: If writes by other connections restarted the
+        copy more than max_restarts times.
+    """
+    page_size = _page_size(src)
+    copied = [0]
+    restarts = [0]
+
+    def progress(status, remaining, total):
+        done = total - remaining
+        if done < copied[0]:
+            # Another connection wrote to the file, so the copy started
+            # again.
+            restarts[0] += 1
+            if max_restarts is not None and restarts[0] > max_restarts:
+                raise _TooManyRestarts()
+            copied[0] = 0
+        budget.spend((done - copied[0]) * page_size)
+        copied[0] = done
+        budget.progress(label, done, total)
+
+    src.backup(dest, pages=step_pages, progress=progress)
+
+
+def backup_file(src_path, dest_path, budget, step_pages=None):
+    """
+    Copy a SQLite file with the online backup API, a few pages per step.
+
+    In WAL mode, the copy is made from one read transaction, so it is never
+    restarted and writers are not blocked. In the default rollback journal
+    mode, a read transaction would block writers, so each step reads the
+    latest file and a write restarts the copy. If writes keep restarting
+    it, the copy is made again from one read transaction, which makes
+    writers wait until it is done.
+
+    :param src_path: Path to the SQLite file to back up.
+    :param dest_path: Path to write the copy to. This must not exist.
+    :param budget: IOBudget instance.
+    :param step_pages: Count of pages to copy in each step. Defaults to the
+        configured count.
+
+    :return: None
+    """
+    step_pages = step_pages or conf.getint('backup', 'step_pages')
+    label = "Backing up {}".format(os.path.basename(src_path))
+    src = sqlite3.connect(src_path, isolation_level=None)
+    dest = sqlite3.connect(dest_path)
+    try:
+        journal_mode = src.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode == 'wal':
+            _begin_read(src)
+            _copy(src, dest, budget, step_pages, label)
+        else:
+            try:
+                _copy(src, dest, budget, step_pages, label, MAX_RESTARTS)
+            except _TooManyRestarts:
+                print("Writes to {} keep restarting the backup. Copying it"
+                      " while holding a read lock.".format(src_path))
+                _begin_read(src)
+                _copy(src, dest, budget, step_pages, label)
+    finally:
+        dest.close()
+        src.close()
+
+
+def archive_processed(dest_path, budget):
+    """
+    Write the processed JSON files to a gzipped tar file.
+
+    :return: Count of files added.
+    """
+    processed_dir = conf.get('text_files', 'processed_dir')
+    count = 0
+
+    with tarfile.open(dest_path, 'w:gz') as tar:
+        for name in sorted(os.listdir(processed_dir)):
+            path = os.path.join(processed_dir, name)
+            if not os.path.isfile(path) or name.startswith('.'):
+                continue
+            tar.add(path, arcname=os.path.join('processed', name))
+            budget.spend(os.path.getsize(path))
+            count += 1
+
+    return count
+
+
+def backup(dest_dir=None, include_processed=False, mb_per_second=None,
+           step_pages=None):
+    """
+    Back up the main database file, any shard files and optionally the
+    processed files to a new directory.
+
+    :param dest_dir: Directory to create the backup in. Defaults to a
+        directory named by the current time in the configured backup
+        directory.
+    :param include_processed: If True, add the processed JSON files as a
+        gzipped tar file.
+    :param mb_per_second: I/O budget in MB per second. Defaults to the
+        configured budget. Set to 0 for no limit.
+    :param step_pages: Count of pages to copy in each step.
+
+    :return: Path to the backup directory.
+    """
+    if dest_dir is None:
+        dest_dir = os.path.join(
+            conf.get('backup', 'backup_dir'),
+            datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        )
+    if mb_per_second is None:
+        mb_per_second = conf.getfloat('backup', 'io_budget_mb')
+    os.makedirs(dest_dir)
+
+    for src_path, name in _db_files():
+        dest_path = os.path.join(dest_dir, name)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        budget = IOBudget(mb_per_second)
+        backup_file(src_path, dest_path, budget, step_pages)
+        budget.report("Backed up {}".format(name))
+
+    if include_processed:
+        budget = IOBudget(mb_per_second)
+        count = archive_processed(os.path.join(dest_dir, 'processed.tar.gz'),
+                                  budget)
+        budget.report("Archived {} processed files".format(count))
+
+    return dest_dir
+
+
+def enable_wal(db_path):
+    """
+    Set the journal mode of a SQLite file to WAL.
+
+    The mode is kept in the file, so this only needs to be done once.
+
+    :return: True if the file was changed, False if it was already in WAL
+        mode.
+    """
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        if db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+            return False
+        db.execute("PRAGMA journal_mode = WAL")
+    finally:
+        db.close()
+
+    return True
+
+
+def enable_incremental_vacuum(db_path):
+    """
+    Set auto_vacuum to INCREMENTAL on a SQLite file.
+
+    An existing file needs a full VACUUM for this to take effect, which
+    rewrites the file and blocks other connections while it runs. This only
+    needs to be done once.
+
+    :return: True if the file was changed, False if it was already in
+        incremental mode.
+    """
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        mode = db.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode == AUTO_VACUUM_INCREMENTAL:
+            return False
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+    return True
+
+
+def compact_file(db_path, budget, step_pages=None):
+    """
+    Give free pages in a SQLite file back to the file system, a few at
+    a time.
+
+    Each step is its own short transaction, so writers can run between
+    steps. The file must be in incremental auto_vacuum mode. Progress is
+    printed after steps, at most once per PROGRESS_SECONDS.
+
+    :return: Count of pages freed.
+    """
+    step_pages = step_pages or conf.getint('backup', 'step_pages')
+    db = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    try:
+        mode = db.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode != AUTO_VACUUM_INCREMENTAL:
+            raise ValueError("Incremental vacuum is not enabled on {}. Run"
+                             " with --enable-incremental first."
+                             .format(db_path))
+        page_size = _page_size(db)
+        label = "Compacting {}".format(os.path.basename(db_path))
+        freed = 0
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        total = free
+        while free:
+            # The pragma frees one page per step of the statement, so run
+            # it as a script, which steps it to the end.
+            db.executescript("PRAGMA incremental_vacuum({:d});"
+                             .format(min(free, step_pages)))
+            remaining = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                break
+            freed += free - remaining
+            budget.spend((free - remaining) * page_size)
+            budget.progress(label, freed, total)
+            free = remaining
+    finally:
+        db.close()
+
+    return freed
+
+
+def main():
+    """
+    Command-line function to back up or compact the database.
+    """
+    parser = argparse.ArgumentParser("Database backup")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--compact',
+        action='store_true',
+        help="Reclaim free space in the database files with an incremental"
+             " vacuum, instead of making a backup."
+    )
+    group.add_argument(
+        '--enable-wal',
+        action='store_true',
+        help="Switch the database files to WAL journal mode, so that backups"
+             " do not block writers."
+    )
+    group.add_argument(
+        '--enable-incremental',
+        action='store_true',
+        help="Switch the database files to incremental auto_vacuum mode."
+             " This runs a full VACUUM once, which blocks other writers."
+    )
+    parser.add_argument(
+        '--dest',
+        help="Directory to write the backup to. Defaults to a new directory"
+             " in the configured backup directory."
+    )
+    parser.add_argument(
+        '--processed',
+        action='store_true',
+        help="Add the processed JSON files to the backup as a gzipped tar"
+             " file."
+    )
+    parser.add_argument(
+        '--io-budget',
+        type=float,
+        metavar='MB',
+        help="Most MB to read or write per second. Set to 0 for no limit."
+             " Defaults to the configured budget."
+    )
+    parser.add_argument(
+        '--step-pages',
+        type=int,
+        help="Count of database pages to copy or free in each step."
+             " Defaults to the configured count."
+    )
+    args = parser.parse_args()
+
+    if args.enable_wal:
+        for path, _ in _db_files():
+            changed = enable_wal(path)
+            print("{}: {}".format(path, "enabled" if changed
+                                  else "already enabled"))
+    elif args.enable_incremental:
+        for path, _ in _db_files():
+            changed = enable_incremental_vacuum(path)
+            print("{}: {}".format(path, "enabled" if changed
+                                  else "already enabled"))
+    elif args.compact:
+        mb_per_second = args.io_budget
+        if mb_per_second is None:
+            mb_per_second = conf.getfloat('backup', 'io_budget_mb')
+        for path, _ in _db_files():
+            budget = IOBudget(mb_per_second)
+            freed = compact_file(path, budget, args.step_pages)
+            budget.report("Freed {:,d} pages from {}".format(freed, path))
+    else:
+        dest_dir = backup(args.dest, args.processed, args.io_budget,
+                          args.step_pages)
+        print("Backup: {}".format(dest_dir))
+
+
+if __name__ == '__main__':
+    main()
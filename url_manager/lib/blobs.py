@@ -0,0 +1,491 @@
+"""
+Lib blobs module.
+
+A content-addressed store for downloaded files such as favicons and preview
+images. Each file is named by the SHA-256 hash of its content and kept in
+directories named by the first characters of the hash, like
+'ab/cd/abcd...'. A file which many domains or pages use, such as a common
+favicon, is only stored once.
+
+The Blob table records each file in the store and the BlobLink table records
+which domains and pages use it. Downloads run in a pool of threads, and a URL
+is only downloaded once, however many domains or pages point to it. When
+the store is over its configured size, the least recently used files are
+removed.
+
+Files are served by handing the open file to the kernel with sendfile, so
+the content is not copied through Python.
+
+Usage:
+    $ python -m lib.blobs --icons
+    $ python -m lib.blobs --images
+    $ python -m lib.blobs --stats
+
+    Run a check against a local server:
+    $ python -c 'from lib import blobs; blobs.test()'
+"""
+import argparse
+import datetime
+import hashlib
+import http.client
+import os
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlobject import SQLObjectNotFound
+
+from lib.config import AppConf
+from lib.database import (DATETIME_FORMAT, Blob, BlobLink, Domain,
+                          iter_pages, raw_transaction)
+
+
+conf = AppConf()
+
+MB = 1024 * 1024
+
+# Larger files are not downloaded, since they are unlikely to be icons or
+# preview images.
+MAX_DOWNLOAD_BYTES = 5 * MB
+TIMEOUT_SECONDS = 10
+USER_AGENT = 'url-manager'
+
+
+def _now():
+    return datetime.datetime.now().strftime(DATETIME_FORMAT)
+
+
+def download(url):
+    """
+    Download a URL.
+
+    :raises ValueError: If the content is larger than MAX_DOWNLOAD_BYTES.
+    :raises OSError: If the request fails.
+    :raises http.client.HTTPException: If the server's response is not
+        valid HTTP.
+
+    :return: 2-tuple of content as bytes and content type, which may be
+        None.
+    """
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS) as resp:
+        data = resp.read(MAX_DOWNLOAD_BYTES + 1)
+        content_type = resp.headers.get_content_type() \
+            if resp.headers.get('Content-Type') else None
+
+    if len(data) > MAX_DOWNLOAD_BYTES:
+        raise ValueError("Larger than {:,d} bytes.".format(MAX_DOWNLOAD_BYTES))
+
+    return data, content_type
+
+
+class BlobStore:
+    """
+    Directory of files named by the SHA-256 hash of their content.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        """
+        Initialise instance of BlobStore class.
+
+        :param root: Directory of the store. Defaults to the configured
+            directory.
+        :param max_bytes: Most bytes to keep in the store. Defaults to the
+            configured size.
+        """
+        self.root = root or conf.get('blobs', 'blob_dir')
+        if max_bytes is None:
+            max_bytes = int(conf.getfloat('blobs', 'max_size_mb') * MB)
+        self.max_bytes = max_bytes
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def write(self, data):
+        """
+        Write content to the store if it is not there already.
+
+        This only writes the file, so it is safe to call from many threads
+        at once. The file is written under a temporary name and then
+        renamed, so a reader never sees part of a file.
+
+        :return: SHA-256 hex digest of the content.
+        """
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path(sha256)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f_out:
+                    f_out.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+
+        return sha256
+
+    def record(self, sha256, size, content_type=None):
+        """
+        Return the Blob record for a file in the store, creating it if it
+        does not exist and marking it as used.
+        """
+        try:
+            blob = Blob.bySha256(sha256)
+            blob.last_used = datetime.datetime.now()
+        except SQLObjectNotFound:
+            blob = Blob(sha256=sha256, size=size, content_type=content_type)
+
+        return blob
+
+    def put(self, data, content_type=None):
+        """
+        Add content to the store.
+
+        :return: Blob record.
+        """
+        sha256 = self.write(data)
+
+        return self.record(sha256, len(data), content_type)
+
+    def touch(self, sha256):
+        """
+        Mark a file as used, so it is kept over files which were used less
+        recently.
+        """
+        with raw_transaction() as raw_conn:
+            raw_conn.execute(
+                "UPDATE {} SET last_used = ? WHERE sha256 = ?".format(
+                    Blob.sqlmeta.table),
+                (_now(), sha256)
+            )
+
+    def open(self, sha256):
+        """
+        Open a file in the store for reading in binary mode.
+
+        :raises FileNotFoundError: If the file is not in the store.
+        """
+        f_in = open(self.path(sha256), 'rb')
+        self.touch(sha256)
+
+        return f_in
+
+    def send(self, sha256, sock, offset=0, count=None):
+        """
+        Send a file in the store to a socket.
+
+        The kernel copies the file to the socket with sendfile where the
+        platform supports it, without passing the content through Python.
+
+        :param sock: Connected socket.socket object.
+        :param offset: Byte offset to start from, for range requests.
+        :param count: Count of bytes to send. Defaults to the rest of the
+            file.
+
+        :return: Count of bytes sent.
+        """
+        with self.open(sha256) as f_in:
+            return sock.sendfile(f_in, offset, count)
+
+    def total_size(self):
+        return Blob._connection.queryOne(
+            "SELECT COALESCE(SUM(size), 0) FROM {}".format(Blob.sqlmeta.table)
+        )[0]
+
+    def evict(self):
+        """
+        Remove the least recently used files until the store is within its
+        size limit.
+
+        Links to a removed file are removed too, so it will be downloaded
+        again if it is needed.
+
+        :return: Count of files removed.
+        """
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+
+        rows = Blob._connection.queryAll(
+            "SELECT id, sha256, size FROM {} ORDER BY last_used, id".format(
+                Blob.sqlmeta.table))
+        removed = []
+        for blob_id, sha256, size in rows:
+            if excess <= 0:
+                break
+            removed.append((blob_id, sha256))
+            excess -= size
+
+        with raw_transaction() as raw_conn:
+            for table, column in ((BlobLink.sqlmeta.table, 'blob_id'),
+                                  (Blob.sqlmeta.table, 'id')):
+                raw_conn.executemany(
+                    "DELETE FROM {} WHERE {} = ?".format(table, column),
+                    ((blob_id,) for blob_id, _ in removed)
+                )
+        Blob._connection.cache.clear(Blob)
+
+        for _, sha256 in removed:
+            try:
+                os.remove(self.path(sha256))
+            except FileNotFoundError:
+                pass
+
+        return len(removed)
+
+
+def _known_urls(urls):
+    """
+    Return Blob IDs of files already downloaded from any of the URLs.
+
+    :return: dict of Blob ID by URL.
+    """
+    urls = list(urls)
+    known = {}
+
+    with raw_transaction() as raw_conn:
+        # Look up in chunks to stay under SQLite's limit on parameters.
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i + 500]
+            rows = raw_conn.execute(
+                "SELECT url, blob_id FROM {} WHERE url IN ({})".format(
+                    BlobLink.sqlmeta.table, ", ".join("?" * len(chunk))),
+                chunk
+            )
+            known.update(rows)
+
+    return known
+
+
+def fetch_urls(store, urls, workers=None):
+    """
+    Download URLs into the store, once each.
+
+    URLs which files have already been downloaded from are not downloaded
+    again. Downloads run in a pool of threads, which write the files. Blob
+    records are written in this thread as downloads finish.
+
+    :param store: BlobStore instance.
+    :param urls: Iterable of URLs. Duplicates are ignored.
+    :param workers: Count of downloads to run at once. Defaults to the
+        configured count.
+
+    :return: 2-tuple of Blob IDs and errors.
+        blob_ids: dict of Blob ID by URL, for URLs which are in the store.
+        errors: dict of error message by URL, for URLs which failed.
+    """
+    workers = workers or conf.getint('blobs', 'workers')
+    urls = set(urls)
+    blob_ids = _known_urls(urls)
+    new_urls = sorted(urls - set(blob_ids))
+    errors = {}
+
+    def fetch(url):
+        try:
+            data, content_type = download(url)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            return url, None, str(e) or e.__class__.__name__
+
+        return url, (store.write(data), len(data), content_type), None
+
+    with ThreadPoolExecutor(workers) as executor:
+        for url, result, error in executor.map(fetch, new_urls):
+            if error is not None:
+                errors[url] = error
+            else:
+                blob_ids[url] = store.record(*result).id
+
+    return blob_ids, errors
+
+
+def _link(blob_ids, targets, kind, column):
+    """
+    Insert BlobLink rows for targets which have a blob.
+
+    :param targets: list of 2-tuples of target ID and URL.
+    :param column: One of 'domain_id' or 'page_id'.
+
+    :return: Count of links added.
+    """
+    rows = [(blob_ids[url], target_id, kind, url)
+            for target_id, url in targets if url in blob_ids]
+
+    with raw_transaction() as raw_conn:
+        raw_conn.executemany(
+            "INSERT INTO {} (blob_id, {}, kind, url) VALUES (?, ?, ?, ?)"
+            .format(BlobLink.sqlmeta.table, column),
+            rows
+        )
+
+    return len(rows)
+
+
+def _linked_ids(kind, column):
+    return {row[0] for row in BlobLink._connection.queryAll(
+        "SELECT {} FROM {} WHERE kind = {}".format(
+            column, BlobLink.sqlmeta.table,
+            BlobLink._connection.sqlrepr(kind)))}
+
+
+def fetch_icons(store, workers=None):
+    """
+    Download the favicon of each domain which does not have one yet.
+
+    The icon is read from the default '/favicon.ico' path of the domain.
+
+    :return: 2-tuple of count of links added and dict of errors by URL.
+    """
+    linked = _linked_ids('icon', 'domain_id')
+    targets = [(domain_id, value + '/favicon.ico')
+               for domain_id, value in Domain._connection.queryAll(
+                   "SELECT id, value FROM {}".format(Domain.sqlmeta.table))
+               if domain_id not in linked]
+
+    blob_ids, errors = fetch_urls(store, (url for _, url in targets),
+                                  workers)
+    added = _link(blob_ids, targets, 'icon', 'domain_id')
+    store.evict()
+
+    return added, errors
+
+
+def fetch_images(store, workers=None):
+    """
+    Download the preview image of each page which has an image URL and
+    does not have the image yet.
+
+    :return: 2-tuple of count of links added and dict of errors by URL.
+    """
+    linked = _linked_ids('image', 'page_id')
+    targets = [(page.id, page.image_url)
+               for page in iter_pages(columns=('id', 'image_url'))
+               if page.image_url and page.id not in linked]
+
+    blob_ids, errors = fetch_urls(store, (url for _, url in targets),
+                                  workers)
+    added = _link(blob_ids, targets, 'image', 'page_id')
+    store.evict()
+
+    return added, errors
+
+
+def test():
+    """
+    Download from a local stand-in server into a temporary store.
+
+    The server has two URLs with the same content and one missing URL. The
+    Blob records made are removed at the end.
+    """
+    import http.server
+    import socket
+    import threading
+
+    content = b'\x00icon' * 100
+    routes = {'/a.ico': content, '/b.ico': content, '/c.png': b'image'}
+    request_counts = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            request_counts[self.path] = request_counts.get(self.path, 0) + 1
+            body = routes.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/x-icon')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    urls = [base + path for path in ('/a.ico', '/b.ico', '/c.png',
+                                     '/missing.ico', '/a.ico')]
+
+    with tempfile.TemporaryDirectory() as root:
+        store = BlobStore(root, max_bytes=len(content))
+        blob_ids, errors = fetch_urls(store, urls, workers=4)
+        try:
+            print("Requests: {}".format(request_counts))
+            print("Blobs: {} for {} URLs".format(len(set(blob_ids.values())),
+                                                 len(blob_ids)))
+            print("Errors: {}".format(errors))
+
+            sha256 = Blob.get(blob_ids[base + '/a.ico']).sha256
+            sender, receiver = socket.socketpair()
+            with sender, receiver:
+                sent = store.send(sha256, sender)
+                received = receiver.recv(sent, socket.MSG_WAITALL)
+            print("Sent: {} bytes, matches: {}".format(sent,
+                                                       received == content))
+        finally:
+            server.shutdown()
+            with raw_transaction() as raw_conn:
+                raw_conn.executemany(
+                    "DELETE FROM {} WHERE id = ?".format(Blob.sqlmeta.table),
+                    ((blob_id,) for blob_id in set(blob_ids.values()))
+                )
+            Blob._connection.cache.clear(Blob)
+
+
+def main():
+    """
+    Command-line function to download icons or images, or show the size of
+    the store.
+    """
+    parser = argparse.ArgumentParser("Blob store")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        '--icons',
+        action='store_true',
+        help="Download favicons for domains which do not have one."
+    )
+    group.add_argument(
+        '--images',
+        action='store_true',
+        help="Download preview images for pages which have an image URL."
+    )
+    group.add_argument(
+        '--evict',
+        action='store_true',
+        help="Remove the least recently used files until the store is"
+             " within its size limit."
+    )
+    group.add_argument(
+        '--stats',
+        action='store_true',
+        help="Show the count and size of files in the store."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help="Count of downloads to run at once. Defaults to the configured"
+             " count."
+    )
+    args = parser.parse_args()
+
+    store = BlobStore()
+    if args.icons or args.images:
+        fetch = fetch_icons if args.icons else fetch_images
+        added, errors = fetch(store, args.workers)
+        for url, error in sorted(errors.items()):
+            print(" {url}: {error}".format(url=url, error=error))
+        print("Links added: {:,d}. Failed URLs: {:,d}.".format(added,
+                                                               len(errors)))
+    elif args.evict:
+        print("Files removed: {:,d}".format(store.evict()))
+    else:
+        print("Files: {:,d}".format(Blob.select().count()))
+        print("Size: {:,.1f} MB of {:,.1f} MB".format(
+            store.total_size() / MB, store.max_bytes / MB))
+
+
+if __name__ == '__main__':
+    main()
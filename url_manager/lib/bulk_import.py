@@ -0,0 +1,356 @@
+"""
+Lib bulk import module.
+
+Import a large text file of URLs straight into the database. Two formats are
+supported:
+
+    csv: The manual-bulk format, a CSV file created by hand or by a script.
+        The first line is a header and the columns are:
+            url,title,folder,date_added
+        Only url is required, the others may be left empty or left out of
+        the header and rows from the end. date_added is
+        in the format "2020-01-31 17:57". A field may not contain a line
+        break.
+    onetab: The plain text export from OneTab, with one "url | title" per
+        line. Blank lines between groups are skipped, since groups have no
+        names in the export.
+
+Pages without a folder are put in a folder named after the file.
+
+The file is split into chunks at byte offsets and each chunk is parsed,
+split into domain and path and validated in a pool of processes. The main
+process inserts the domains and pages of each chunk in bulk as chunks are
+ready. Only a few chunks per process are handed to the pool ahead of the
+inserts, so memory use stays flat for any size of file.
+
+Usage:
+    $ python -m lib.bulk_import PATH [--format csv|onetab] [--workers N]
+"""
+import argparse
+import csv
+import datetime
+import multiprocessing
+import os
+from collections import deque
+
+from lib import convert, shards, validators
+from lib.database import (DATETIME_FORMAT, bulk_insert_domains,
+                          get_or_create_folder, get_or_create_source,
+                          raw_transaction)
+
+
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# Chunks to keep queued for each worker process, so workers do not wait for
+# the next chunk while the main process inserts.
+PENDING_CHUNKS_PER_WORKER = 2
+
+CSV_COLUMNS = ['url', 'title', 'folder', 'date_added']
+
+FORMAT_NAMES = {
+    'csv': 'manual-bulk',
+    'onetab': 'onetab',
+}
+
+
+def chunk_ranges(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Split a file into byte ranges of about the same size.
+
+    :return: list of 2-tuples of start and end offsets.
+    """
+    size = os.path.getsize(path)
+
+    return [(start, min(start + chunk_bytes, size))
+            for start in range(0, size, chunk_bytes)]
+
+
+def read_lines(path, start, end, report):
+    """
+    Read the lines which start within a byte range of a file.
+
+    A line which crosses the end of the range is read in full, and a line
+    which crosses the start is left for the previous range, so each line
+    is read by exactly one range.
+
+    A line which is not valid UTF-8 is added to the report and read as an
+    empty line, so the other lines keep their positions.
+
+    :param report: ValidationReport to add errors to, indexed by position
+        in the returned list.
+
+    :return: list of str lines, without line endings.
+    """
+    lines = []
+
+    with open(path, 'rb') as f_in:
+        if start:
+            f_in.seek(start - 1)
+            # Skip to the end of the line which the previous range reads.
+            f_in.readline()
+        while f_in.tell() < end:
+            line = f_in.readline()
+            if not line:
+                break
+            try:
+                lines.append(line.decode('utf-8').rstrip('\r\n'))
+            except UnicodeDecodeError:
+                report.add('text', len(lines),
+                           line.decode('utf-8', 'replace').rstrip('\r\n'),
+                           "Invalid UTF-8 text.")
+                lines.append('')
+
+    if start == 0 and lines:
+        lines[0] = lines[0].lstrip('\ufeff')
+
+    return lines
+
+
+def check_csv_header(path):
+    """
+    Check that the first line of a CSV file is the expected header.
+
+    The header may leave out columns from the end, since they are optional.
+
+    :raises ValueError: If the header does not match CSV_COLUMNS.
+    """
+    with open(path, encoding='utf-8-sig', errors='replace') as f_in:
+        header = next(csv.reader([f_in.readline()]), [])
+
+    header = [column.strip() for column in header]
+    columns = [column.lower() for column in header]
+    if not columns or columns != CSV_COLUMNS[:len(columns)]:
+        raise ValueError("Expected a CSV header of: {}. Found: {}".format(
+            ",".join(CSV_COLUMNS), ",".join(header) or "an empty line"))
+
+
+def parse_csv(lines, is_first):
+    """
+    Parse CSV lines into dicts of url, title, folder and date_added.
+
+    The first line of the file is skipped as the header, which is checked
+    by check_csv_header before the file is parsed.
+
+    :return: iterator of 2-tuples of line offset within lines and dict.
+    """
+    skip = 1 if is_first else 0
+    reader = csv.reader(lines[skip:])
+
+    for row in reader:
+        if not row:
+            continue
+        row += [''] * (len(CSV_COLUMNS) - len(row))
+        yield skip + reader.line_num - 1, dict(zip(CSV_COLUMNS, row))
+
+
+def parse_onetab(lines, is_first):
+    """
+    Parse OneTab export lines into dicts of url and title.
+
+    :return: iterator of 2-tuples of line offset within lines and dict.
+    """
+    for offset, line in enumerate(lines):
+        if not line.strip():
+            continue
+        url, _, title = line.partition(' | ')
+        yield offset, {'url': url, 'title': title, 'folder': '',
+                       'date_added': ''}
+
+
+PARSERS = {
+    'csv': parse_csv,
+    'onetab': parse_onetab,
+}
+
+
+def parse_chunk(path, start, end, format_name):
+    """
+    Parse and validate the lines of one chunk of a file.
+
+    This runs in a worker process.
+
+    :return: 3-tuple of rows, errors and count of lines.
+        rows: list of 5-tuples of domain, path, title, date added and folder
+            name, for valid lines.
+        errors: list of error tuples as in ValidationReport, indexed by the
+            line offset within the chunk.
+        count of lines: Count of lines read, so line numbers in the file
+            can be worked out from the offsets.
+    """
+    report = validators.ValidationReport()
+    lines = read_lines(path, start, end, report)
+    parsed = list(PARSERS[format_name](lines, start == 0))
+
+    splits = [convert.split_url(record['url']) for _, record in parsed]
+    domain_report = validators.ValidationReport()
+    domains = validators.validate_domains([d for d, _ in splits],
+                                          domain_report)
+    # Report the URL as given, on its line, rather than the domain.
+    for _, index, _, message in domain_report.errors:
+        offset, record = parsed[index]
+        report.add('url', offset, record['url'], message)
+    now = datetime.datetime.now().strftime(DATETIME_FORMAT)
+
+    rows = []
+    for (offset, record), domain, (_, url_path) in zip(parsed, domains,
+                                                       splits):
+        if domain is None:
+            continue
+        date_added = now
+        if record['date_added']:
+            try:
+                date_added = datetime.datetime.strptime(
+                    record['date_added'], convert.DATETIME_FORMAT
+                ).strftime(DATETIME_FORMAT)
+            except ValueError:
+                report.add('date_added', offset, record['date_added'],
+                           "Invalid date.")
+                continue
+        rows.append((domain, url_path, record['title'] or None, date_added,
+                     record['folder']))
+
+    return rows, report.errors, len(lines)
+
+
+def iter_parsed_chunks(pool, tasks, max_pending):
+    """
+    Parse chunks in a pool of processes, yielding results in order.
+
+    Only max_pending chunks are queued or parsed but not yet consumed at a
+    time, so parsed rows do not pile up in memory when the caller inserts
+    them slower than the pool parses them.
+
+    :param pool: multiprocessing.Pool instance.
+    :param tasks: Iterable of argument tuples for parse_chunk.
+    :param max_pending: Most chunks to submit ahead of the one consumed.
+
+    :return: Generator of results of parse_chunk.
+    """
+    pending = deque()
+
+    for task in tasks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(parse_chunk, task))
+    while pending:
+        yield pending.popleft().get()
+
+
+def insert_rows(rows, source_id, default_folder, folder_ids):
+    """
+    Insert a chunk of parsed rows, creating domains and folders as needed.
+
+    Pages which are already in the same folder are skipped.
+
+    :param folder_ids: dict of Folder IDs by name, which is updated with any
+        folders created.
+
+    :return: Count of pages inserted.
+    """
+    domain_ids = bulk_insert_domains(row[0] for row in rows)
+
+    for row in rows:
+        name = row[4] or default_folder
+        if name not in folder_ids:
+            folder_ids[name] = get_or_create_folder((name,)).id
+
+    with raw_transaction() as raw_conn:
+        before = raw_conn.total_changes
+        raw_conn.executemany(
+            "INSERT OR IGNORE INTO {} (domain_id, path, title, created_at,"
+            " folder_id, source_id) VALUES (?, ?, ?, ?, ?, ?)".format(
+                shards.page_table(source_id)),
+            ((domain_ids[domain], url_path, title, date_added,
+              folder_ids[folder or default_folder], source_id)
+             for domain, url_path, title, date_added, folder in rows)
+        )
+        inserted = raw_conn.total_changes - before
+
+    return inserted
+
+
+def import_file(path, format_name='csv', workers=None, browser=None,
+                location=None, is_work=False):
+    """
+    Import a CSV or OneTab text file into the database.
+
+    :param path: Path to the file.
+    :param format_name: One of 'csv' or 'onetab'.
+    :param workers: Count of processes to parse with. Defaults to the count
+        of CPUs.
+    :param browser: Optional browser name for the Source.
+    :param location: Optional location name for the Source.
+    :param is_work: True if the data is work related.
+
+    :raises ValueError: If the browser or location name is invalid, or a
+        CSV file does not have the expected header.
+
+    :return: 2-tuple of count of pages inserted and ValidationReport, with
+        errors indexed by line number in the file.
+    """
+    if format_name == 'csv':
+        check_csv_header(path)
+    source = get_or_create_source(FORMAT_NAMES[format_name], browser,
+                                  location, is_work)
+    default_folder = os.path.splitext(os.path.basename(path))[0]
+    folder_ids = {}
+    report = validators.ValidationReport(index_name='line')
+    inserted = 0
+    # Line number in the file of the first line of the next chunk.
+    first_line = 1
+
+    workers = workers or os.cpu_count()
+    tasks = ((path, start, end, format_name)
+             for start, end in chunk_ranges(path))
+    with multiprocessing.Pool(workers) as pool:
+        results = iter_parsed_chunks(pool, tasks,
+                                     workers * PENDING_CHUNKS_PER_WORKER)
+        # Chunks arrive in order, so line numbers can be counted up.
+        for rows, errors, line_count in results:
+            for column, offset, value, message in errors:
+                report.add(column, first_line + offset, value, message)
+            first_line += line_count
+            inserted += insert_rows(rows, source.id, default_folder,
+                                    folder_ids)
+
+    return inserted, report
+
+
+def main():
+    """
+    Command-line function to import a CSV or OneTab text file.
+    """
+    parser = argparse.ArgumentParser("Bulk importer")
+    parser.add_argument('PATH', help="Path to the file to import.")
+    parser.add_argument(
+        '--format',
+        choices=sorted(PARSERS),
+        default='csv',
+        help="Format of the file. Default: %(default)s."
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help="Count of processes for parsing. Defaults to the count of CPUs."
+    )
+    parser.add_argument('--browser', help="Browser name for the source.")
+    parser.add_argument('--location', help="Location name for the source.")
+    parser.add_argument(
+        '--work',
+        action='store_true',
+        help="Mark the source as work related."
+    )
+    args = parser.parse_args()
+
+    try:
+        inserted, report = import_file(args.PATH, args.format, args.workers,
+                                       args.browser, args.location, args.work)
+    except ValueError as e:
+        parser.error(str(e))
+    if report:
+        report.print_summary()
+    print("Pages added: {:,d}".format(inserted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Lib client module.
+
+Run an app command through the resident server if one is running, or in
+this process if not. See lib/server.py.
+
+This module only imports the standard library and the app conf, so it
+starts quickly. The command's own imports and database connection are
+only paid for when there is no server to run it.
+
+Usage:
+    $ python -m lib.client COMMAND [ARGS ...]
+
+    e.g.
+    $ python -m lib.client lib.delta
+    $ python -m lib.client lib.worker --stats
+"""
+import importlib
+import json
+import os
+import socket
+import sys
+import traceback
+
+from lib.config import AppConf
+
+
+conf = AppConf()
+
+# Commands which can be run, by module name as used with "python -m",
+# mapped to the function which runs them as "module:function".
+COMMANDS = {
+    'transformer': 'transformer:main',
+    'extract_onetab_storage': 'extract_onetab_storage:main',
+    'lib.blobs': 'lib.blobs:main',
+    'lib.bulk_import': 'lib.bulk_import:main',
+    'lib.database': 'lib.database:main',
+    'lib.delta': 'lib.delta:main',
+    'lib.labeler': 'lib.labeler:main',
+    'lib.near_duplicates': 'lib.near_duplicates:main',
+    'lib.shards': 'lib.shards:main',
+    'lib.snapshot': 'lib.snapshot:test',
+    'lib.worker': 'lib.worker:main',
+}
+
+
+def socket_path():
+    return conf.get('server', 'socket_path')
+
+
+def run_command(name, argv, stdout=None, stderr=None):
+    """
+    Run a command in this process, as if from the command-line.
+
+    :param name: Key of COMMANDS.
+    :param argv: list of str arguments for the command.
+    :param stdout: Optional file object to write output to instead of
+        sys.stdout.
+    :param stderr: Optional file object to write errors to instead of
+        sys.stderr.
+
+    :return: Exit code of the command, as int.
+    """
+    module_name, function_name = COMMANDS[name].split(':')
+    old_argv, old_stdout, old_stderr = sys.argv, sys.stdout, sys.stderr
+
+    sys.argv = [name] + list(argv)
+    sys.stdout = stdout or sys.stdout
+    sys.stderr = stderr or sys.stderr
+    try:
+        module = importlib.import_module(module_name)
+        getattr(module, function_name)()
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.argv, sys.stdout, sys.stderr = old_argv, old_stdout, old_stderr
+
+    return 0
+
+
+def request(name, argv, path=None):
+    """
+    Send a command to the server and print its output as it arrives.
+
+    :param name: Key of COMMANDS.
+    :param argv: list of str arguments for the command.
+    :param path: Path to the server's socket. Defaults to the configured
+        path.
+
+    :raises OSError: If no server is listening on the socket.
+
+    :return: Exit code of the command, as int.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or socket_path())
+        message = {'command': name, 'argv': argv, 'cwd': os.getcwd()}
+        sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        with sock.makefile('r', encoding='utf-8') as f_in:
+            for line in f_in:
+                reply = json.loads(line)
+                if 'exit_code' in reply:
+                    return reply['exit_code']
+                stream = sys.stderr if reply['stream'] == 'stderr' \
+                    else sys.stdout
+                stream.write(reply['text'])
+                stream.flush()
+
+    print("Server closed the connection before the command finished.",
+          file=sys.stderr)
+
+    return 1
+
+
+def main():
+    """
+    Command-line function to run a command through the server.
+
+    Argument parsing is left to the command, so this does not use argparse.
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print("Usage: python -m lib.client COMMAND [ARGS ...]\n"
+              "Commands: {}".format(", ".join(sorted(COMMANDS))),
+              file=sys.stderr)
+        sys.exit(2)
+    name, argv = sys.argv[1], sys.argv[2:]
+
+    try:
+        exit_code = request(name, argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        exit_code = run_command(name, argv)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
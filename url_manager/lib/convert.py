@@ -2,6 +2,7 @@
 Lib convert application file.
 """
 import datetime
+from urllib.parse import urlsplit, urlunsplit
 
 
 # The desired format for datetime values in output JSON files.
@@ -48,3 +49,23 @@ def from_onetab_epoch(value):
     seconds = float(value) / 1000
 
     return datetime.datetime.fromtimestamp(seconds)
+
+
+def split_url(url):
+    """
+    Split a URL into the domain and path values used by the db model.
+
+    The scheme and host are kept together as the domain, so that joining
+    the two values again with Page.get_url gives back the original URL. The
+    host is lowercased, as hostnames are case insensitive.
+
+    :param url: Full URL as a str. e.g. 'https://Example.com/abc?d=1'
+
+    :return: 2-tuple of domain and path as str values.
+        e.g. ('https://example.com', '/abc?d=1')
+    """
+    parts = urlsplit(url.strip())
+    domain = "{}://{}".format(parts.scheme.lower(), parts.netloc.lower())
+    path = urlunsplit(('', '', parts.path, parts.query, parts.fragment))
+
+    return domain, path
@@ -6,7 +6,16 @@ See docs for setting up the database.
 Usage:
     $ python -m lib.database [args]
 """
+import argparse
+import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+
+from sqlobject import SQLObjectNotFound
+
 import models
+from lib import hostnames, shards, validators
 from lib.config import AppConf
 
 # Make model objects available on the lib.database module.
@@ -16,6 +25,11 @@ from models.connection import conn
 
 conf = AppConf()
 
+CHUNK_SIZE = 10000
+
+# Format of DateTimeCol values as stored by SQLObject, for writing plain SQL.
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
 
 def initialize(drop_all=False, create_all=True):
     """
@@ -50,8 +64,438 @@ def initialize(drop_all=False, create_all=True):
     return len(models_list)
 
 
+@contextmanager
+def raw_transaction():
+    """
+    Run plain SQL in a transaction on a DB-API connection from the pool.
+
+    Use this for bulk writes, which are much faster than writing through
+    model objects. The transaction is committed at the end of the block, or
+    rolled back on an error.
+
+    :return: Generator of a sqlite3.Connection object, which has any shards
+        attached.
+    """
+    raw_conn = conn.getConnection()
+    try:
+        raw_conn.execute("BEGIN")
+        try:
+            yield raw_conn
+        except Exception:
+            raw_conn.execute("ROLLBACK")
+            raise
+        raw_conn.execute("COMMIT")
+    finally:
+        conn.releaseConnection(raw_conn)
+
+
+def _host_keys(domain_value):
+    host = hostnames.hostname(domain_value)
+
+    return hostnames.reverse_host(host), hostnames.registrable_domain(host)
+
+
+def update_domain_hosts():
+    """
+    Fill in the reversed_host and registrable_domain columns of Domain.
+
+    This brings a database created before those columns existed up to date,
+    adding the columns and their indexes if needed. It can be run again
+    after changing the public suffix list.
+
+    :return: Count of Domain records updated.
+    """
+    table = Domain.sqlmeta.table
+    raw_conn = conn.getConnection()
+    try:
+        columns = {row[1] for row in raw_conn.execute(
+            "PRAGMA table_info({})".format(table))}
+        for column in ('reversed_host', 'registrable_domain'):
+            if column not in columns:
+                raw_conn.execute("ALTER TABLE {0} ADD COLUMN {1} TEXT"
+                                 .format(table, column))
+            raw_conn.execute("CREATE INDEX IF NOT EXISTS {0}_{1}_idx"
+                             " ON {0} ({1})".format(table, column))
+    finally:
+        conn.releaseConnection(raw_conn)
+
+    with raw_transaction() as raw_conn:
+        rows = raw_conn.execute(
+            "SELECT id, value FROM {}".format(table)).fetchall()
+        raw_conn.executemany(
+            "UPDATE {} SET reversed_host = ?, registrable_domain = ?"
+            " WHERE id = ?".format(table),
+            ((*_host_keys(value), domain_id) for domain_id, value in rows)
+        )
+
+    return len(rows)
+
+
+def bulk_insert_domains(values):
+    """
+    Insert many Domain values at once and return their IDs.
+
+    This writes with plain SQL in a single transaction, so the per-row
+    validator on Domain.value is not run. Check the values first with
+    lib.validators.validate_domains. Values which exist already are kept.
+
+    :param values: Iterable of valid, lowercase domain values.
+
+    :return: dict where the key is a domain value and the value is its ID.
+    """
+    values = sorted(set(values))
+    table = Domain.sqlmeta.table
+    now = datetime.datetime.now().strftime(DATETIME_FORMAT)
+
+    with raw_transaction() as raw_conn:
+        raw_conn.executemany(
+            "INSERT OR IGNORE INTO {} (value, reversed_host,"
+            " registrable_domain, datetime_created)"
+            " VALUES (?, ?, ?, ?)".format(table),
+            ((value, *_host_keys(value), now) for value in values)
+        )
+
+        ids = {}
+        # Look up in chunks to stay under SQLite's limit on parameters.
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            rows = raw_conn.execute(
+                "SELECT value, id FROM {} WHERE value IN ({})".format(
+                    table, ", ".join("?" * len(chunk))),
+                chunk
+            )
+            ids.update(rows)
+
+    return ids
+
+
+def get_or_create_folder(folder_path):
+    """
+    Return the Folder record at the end of a path of folder names.
+
+    Folders along the path are created as needed, with each one set as the
+    parent of the next. Since folder names are unique, an existing folder is
+    reused wherever it is in the tree.
+
+    :param folder_path: Sequence of folder names, starting at the top level.
+        e.g. ('Bookmarks bar', 'Python')
+
+    :return: Folder record for the last name in the path, or None if the path
+        is empty.
+    """
+    folder = None
+
+    for name in folder_path:
+        try:
+            folder = Folder.byName(name)
+        except SQLObjectNotFound:
+            folder = Folder(name=name, parent=folder)
+
+    return folder
+
+
+def get_or_create_label(name):
+    """
+    Return the Label record for a name, creating it if it does not exist.
+    """
+    try:
+        return Label.byName(name)
+    except SQLObjectNotFound:
+        return Label(name=name)
+
+
+def bulk_insert_page_labels(pairs):
+    """
+    Insert many PageLabel rows at once with plain SQL.
+
+    Pairs which exist already are skipped, based on PageLabel.unique_idx.
+
+    :param pairs: Iterable of 2-tuples of Page ID and Label ID.
+
+    :return: Count of rows inserted.
+    """
+    with raw_transaction() as raw_conn:
+        before = raw_conn.total_changes
+        raw_conn.executemany(
+            "INSERT OR IGNORE INTO {} (page_id, label_id)"
+            " VALUES (?, ?)".format(PageLabel.sqlmeta.table),
+            pairs
+        )
+        inserted = raw_conn.total_changes - before
+
+    return inserted
+
+
+def get_or_create_source(format_name, browser_name, location_name, is_work):
+    """
+    Return a Source record matching the given metadata, creating it and any
+    of its lookup records if they do not exist.
+
+    Browser and location names may be None, since those are optional on
+    Source. Names are checked and lowercased before they are looked up.
+
+    :raises ValueError: If any of the names is invalid.
+
+    :return: Source record.
+    """
+    report = validators.ValidationReport()
+    names = []
+    for model, name in ((Format, format_name), (Browser, browser_name),
+                        (Location, location_name)):
+        if name is not None:
+            name, = validators.validate_names([name], report,
+                                              column=model.__name__.lower())
+        names.append((model, name))
+    if report:
+        raise ValueError("Invalid source names. {}".format(" ".join(
+            "{}: {!r} - {}".format(column, value, message)
+            for column, _, value, message in report.errors)))
+
+    lookups = []
+    for model, name in names:
+        if name is None:
+            lookups.append(None)
+            continue
+        try:
+            lookups.append(model.byName(name))
+        except SQLObjectNotFound:
+            lookups.append(model(name=name))
+    format_, browser, location = lookups
+
+    results = Source.selectBy(format_=format_, browser=browser,
+                              location=location, is_work=is_work)
+    matches = list(results.limit(1))
+    if matches:
+        source = matches[0]
+    else:
+        source = Source(format_=format_, browser=browser, location=location,
+                        is_work=is_work, date_created=datetime.date.today())
+
+    return source
+
+
+# Columns which the iter functions can select, mapped to their SQL. Page
+# columns are read from the pages view, so sharded pages are included.
+PAGE_FIELDS = {
+    'id': 'page.id',
+    'domain_id': 'page.domain_id',
+    'domain': 'domain.value',
+    'path': 'page.path',
+    'title': 'page.title',
+    'created_at': 'page.created_at',
+    'image_url': 'page.image_url',
+    'description': 'page.description',
+    'folder_id': 'page.folder_id',
+    'source_id': 'page.source_id',
+}
+FOLDER_FIELDS = {
+    'id': 'folder.id',
+    'name': 'folder.name',
+    'parent_id': 'folder.parent_id',
+}
+LABEL_FIELDS = {
+    'id': 'label.id',
+    'name': 'label.name',
+}
+
+
+@lru_cache()
+def _row_type(columns):
+    return namedtuple('Row', columns)
+
+
+def iter_keyset_chunks(from_sql, fields, columns=None, conditions=None,
+                       params=(), chunk_size=CHUNK_SIZE, named=True):
+    """
+    Read rows in chunks ordered by ID, using keyset pagination.
+
+    Each chunk is read with "WHERE id > ? ORDER BY id LIMIT n", starting from
+    the last ID of the previous chunk. Unlike paging with OFFSET, this costs
+    the same for the last chunk as for the first, and only one chunk is held
+    in memory at a time. A connection is only taken from the pool while
+    a chunk is read, so the caller can write to the database between chunks.
+
+    :param from_sql: FROM clause, including any joins.
+    :param fields: dict of column names which can be selected, mapped to
+        their SQL. This must include 'id', which is the key to page on.
+    :param columns: Sequence of names from fields to select. Defaults to all
+        fields.
+    :param conditions: Optional list of SQL conditions, which are joined
+        with AND.
+    :param params: Sequence of values for placeholders in the conditions.
+    :param chunk_size: Most rows in a chunk.
+    :param named: If True, rows are namedtuples with the column names as
+        attributes, otherwise they are plain tuples.
+
+    :return: Generator of lists of rows.
+    """
+    columns = tuple(columns or fields)
+    unknown = [c for c in columns if c not in fields]
+    if unknown:
+        raise ValueError("Unknown columns: {}. Expected any of: {}".format(
+            ", ".join(unknown), ", ".join(fields)))
+
+    # The ID is always read to page on, and dropped afterwards if it was
+    # not asked for.
+    extra_id = 'id' not in columns
+    select = [fields[c] for c in columns]
+    if extra_id:
+        select.append(fields['id'])
+    id_index = len(columns) if extra_id else columns.index('id')
+
+    sql = "SELECT {select} FROM {from_sql} WHERE {where}" \
+        " ORDER BY {key} LIMIT ?".format(
+            select=", ".join(select),
+            from_sql=from_sql,
+            where=" AND ".join(["{} > ?".format(fields['id'])] +
+                               list(conditions or [])),
+            key=fields['id'],
+        )
+    row_type = _row_type(columns) if named else None
+    last_id = 0
+
+    while True:
+        raw_conn = conn.getConnection()
+        try:
+            rows = raw_conn.execute(
+                sql, (last_id, *params, chunk_size)).fetchall()
+        finally:
+            conn.releaseConnection(raw_conn)
+        if not rows:
+            return
+        last_id = rows[-1][id_index]
+
+        if extra_id:
+            rows = [row[:-1] for row in rows]
+        if named:
+            rows = [row_type._make(row) for row in rows]
+        yield rows
+
+
+def iter_page_chunks(chunk_size=CHUNK_SIZE,
+                     columns=('id', 'domain', 'path', 'title'), named=False,
+                     folder_id=None, label_id=None, domain_id=None,
+                     source_id=None, host=None, site=None):
+    """
+    Read pages in chunks, ordered by ID.
+
+    Domain is only joined if the 'domain' column is selected. Pages can be
+    filtered by any of the ID arguments, by host or by site, which are
+    combined with AND.
+
+    :param host: Hostname to select pages on it or any of its subdomains,
+        as for Page.under_host but including sharded pages.
+    :param site: Registrable domain such as 'example.co.uk' to select pages
+        on any host of the site, as for Page.for_site but including sharded
+        pages.
+
+    :param columns: Sequence of names from PAGE_FIELDS to select. Set to
+        None to select all.
+
+    :return: Generator of lists of rows. By default these are plain 4-tuples
+        of Page ID, Domain value, path and title.
+    """
+    from_sql = "{} AS page".format(shards.PAGES_VIEW)
+    if columns is None or 'domain' in columns:
+        from_sql += " JOIN {0} AS domain ON domain.id = page.domain_id" \
+            .format(Domain.sqlmeta.table)
+
+    conditions = []
+    params = []
+    for column, value in (('folder_id', folder_id), ('domain_id', domain_id),
+                          ('source_id', source_id)):
+        if value is not None:
+            conditions.append("page.{} = ?".format(column))
+            params.append(value)
+    if label_id is not None:
+        conditions.append("page.id IN (SELECT page_id FROM {}"
+                          " WHERE label_id = ?)".format(
+                              PageLabel.sqlmeta.table))
+        params.append(label_id)
+    if host is not None:
+        low, high = hostnames.subdomain_range(host)
+        conditions.append("page.domain_id IN (SELECT id FROM {} WHERE"
+                          " reversed_host = ? OR (reversed_host > ?"
+                          " AND reversed_host < ?))".format(
+                              Domain.sqlmeta.table))
+        params.extend((hostnames.reverse_host(host), low, high))
+    if site is not None:
+        conditions.append("page.domain_id IN (SELECT id FROM {}"
+                          " WHERE registrable_domain = ?)".format(
+                              Domain.sqlmeta.table))
+        params.append(site)
+
+    return iter_keyset_chunks(from_sql, PAGE_FIELDS, columns, conditions,
+                              params, chunk_size, named)
+
+
+def iter_pages(columns=None, chunk_size=CHUNK_SIZE, named=True, **filters):
+    """
+    Read pages one at a time, ordered by ID.
+
+    Use this instead of Page.select() or the pages joins of Domain, Folder
+    and Label to walk through many pages, since no model objects are
+    created and memory use does not grow with the count of pages.
+
+    :param columns: Sequence of names from PAGE_FIELDS to select. Defaults to
+        all.
+    :param filters: Any of folder_id, label_id, domain_id, source_id, host
+        and site, as for iter_page_chunks.
+
+    :return: Generator of rows, as namedtuples unless named is False.
+    """
+    for rows in iter_page_chunks(chunk_size, columns, named, **filters):
+        yield from rows
+
+
+def iter_folders(columns=None, chunk_size=CHUNK_SIZE, named=True):
+    """
+    Read folders one at a time, ordered by ID.
+
+    :param columns: Sequence of names from FOLDER_FIELDS to select. Defaults
+        to all.
+
+    :return: Generator of rows, as namedtuples unless named is False.
+    """
+    from_sql = "{} AS folder".format(Folder.sqlmeta.table)
+
+    for rows in iter_keyset_chunks(from_sql, FOLDER_FIELDS, columns,
+                                   chunk_size=chunk_size, named=named):
+        yield from rows
+
+
+def iter_labels(columns=None, chunk_size=CHUNK_SIZE, named=True):
+    """
+    Read labels one at a time, ordered by ID.
+
+    :param columns: Sequence of names from LABEL_FIELDS to select. Defaults
+        to all.
+
+    :return: Generator of rows, as namedtuples unless named is False.
+    """
+    from_sql = "{} AS label".format(Label.sqlmeta.table)
+
+    for rows in iter_keyset_chunks(from_sql, LABEL_FIELDS, columns,
+                                   chunk_size=chunk_size, named=named):
+        yield from rows
+
+
 def main():
+    parser = argparse.ArgumentParser("Database setup")
+    parser.add_argument(
+        '--update-hosts',
+        action='store_true',
+        help="Fill in the host columns of Domain on an existing database,"
+             " instead of recreating the tables."
+    )
+    args = parser.parse_args()
+
     print("Database path: {0}".format(conf.get('db', 'path')))
+    if args.update_hosts:
+        c = update_domain_hosts()
+        print("Updated domains: {}.\n".format(c))
+        return
+
     print("Deleting all tables for develop mode, then creating tables.")
     c = initialize(drop_all=True, create_all=True)
     print("Count of tables: now {}.\n".format(c))
@@ -0,0 +1,375 @@
+"""
+Lib delta import module.
+
+Compare a processed bookmark or OneTab file against the snapshot of it which
+was last added to the database, then apply only the differences. On the first
+import of a file there is no snapshot, so every URL counts as added.
+
+Records are keyed on folder and URL. A URL which disappears from one
+folder and appears in another is treated as moved, rather than as a removal
+plus an addition, so the existing Page record is kept.
+
+Usage:
+    $ python -m lib.delta [FILENAME ...]
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+from collections import namedtuple
+
+from lib import convert, shards, validators
+from lib.config import AppConf
+from lib.database import (DATETIME_FORMAT, BlobLink, PageCluster, PageLabel,
+                          bulk_insert_domains, get_or_create_folder,
+                          get_or_create_source, raw_transaction)
+
+
+conf = AppConf()
+
+Delta = namedtuple('Delta', ['added', 'removed', 'moved', 'retitled'])
+
+
+def flatten(tree, folder_path=()):
+    """
+    Flatten a processed folder tree into a dict of URL records.
+
+    :param tree: dict with 'folders' and 'urls' keys, as per the structure
+        in the transformer module's docstring.
+    :param folder_path: Tuple of folder names leading to the tree.
+
+    :return: dict where the key is a 2-tuple of folder path and URL and the
+        value is the URL's dict of data. A URL repeated within a folder is
+        only kept once, since that is the unique constraint on Page.
+    """
+    records = {}
+
+    for url_data in tree['urls']:
+        records[(folder_path, url_data['url'])] = url_data
+
+    for name, child in tree['folders'].items():
+        records.update(flatten(child, folder_path + (name,)))
+
+    return records
+
+
+def resolve(records, folder_ids):
+    """
+    Key flattened records on Folder ID instead of folder path.
+
+    Folder names are unique, so two paths which end in the same name, such
+    as ('A', 'New folder') and ('B', 'New folder'), are the same folder.
+    A URL in both is the same Page row, so only the record under the first
+    path is kept.
+
+    :param records: dict of records, as from flatten.
+    :param folder_ids: dict of Folder IDs by folder path, as from
+        prepare_folder_ids.
+
+    :return: dict where the key is a 2-tuple of Folder ID, which is None for
+        the top level, and URL.
+    """
+    resolved = {}
+
+    for key in sorted(records):
+        folder_path, url = key
+        resolved.setdefault((folder_ids[folder_path], url), records[key])
+
+    return resolved
+
+
+def _sort_key(key):
+    folder_id, url = key
+
+    return (folder_id is not None, folder_id or 0, url)
+
+
+def diff(old_records, new_records):
+    """
+    Compare the records of two processed folder trees.
+
+    :param old_records: Resolved records of the tree as it was last
+        imported. Use an empty dict for a first import.
+    :param new_records: Resolved records of the tree to be imported.
+
+    :return: Delta namedtuple of lists, where each item is a 2-tuple of
+        (folder_id, url) key and URL data.
+            added: Records which only exist in the new tree.
+            removed: Records which only exist in the old tree.
+            moved: Records in the new tree whose URL was in a different folder
+                in the old tree. The item is a 3-tuple, with the old Folder
+                ID added at the end.
+            retitled: Records in the same folder in both trees, but with
+                a different title in the new tree.
+    """
+    retitled = []
+    for key in sorted(old_records.keys() & new_records.keys(),
+                      key=_sort_key):
+        if old_records[key]['title'] != new_records[key]['title']:
+            retitled.append((key, new_records[key]))
+
+    removed_keys = old_records.keys() - new_records.keys()
+    added_keys = new_records.keys() - old_records.keys()
+
+    # Pair up URLs which left one folder with the same URLs which arrived in
+    # another folder.
+    removed_by_url = {}
+    for folder_id, url in sorted(removed_keys, key=_sort_key):
+        removed_by_url.setdefault(url, []).append(folder_id)
+
+    moved = []
+    added = []
+    for key in sorted(added_keys, key=_sort_key):
+        folder_id, url = key
+        old_folder_ids = removed_by_url.get(url)
+        if old_folder_ids:
+            old_folder_id = old_folder_ids.pop(0)
+            removed_keys.discard((old_folder_id, url))
+            moved.append((key, new_records[key], old_folder_id))
+        else:
+            added.append((key, new_records[key]))
+
+    removed = [(key, old_records[key])
+               for key in sorted(removed_keys, key=_sort_key)]
+
+    return Delta(added, removed, moved, retitled)
+
+
+def source_metadata(filename):
+    """
+    Get Source values from a processed filename.
+
+    e.g. "bookmarks_chrome_mycompany_work.json" gives a format of "bookmarks",
+    browser of "chrome", location of "mycompany" and is_work of True.
+
+    :return: 4-tuple of format name, browser name, location name and is_work.
+    """
+    description = os.path.splitext(filename)[0]
+    try:
+        area, browser, location, purpose = description.split('_')
+    except ValueError:
+        raise ValueError("Could not get metadata from filename: {}"
+                         .format(filename))
+
+    return area, browser, location, purpose == 'work'
+
+
+def prepare_folder_ids(*record_sets):
+    """
+    Get IDs for the folders which flattened records refer to, creating any
+    which are missing.
+
+    :param record_sets: dicts of records, as from flatten.
+
+    :return: dict of Folder IDs for each folder path. The empty path has an
+        ID of None.
+    """
+    folder_paths = {folder_path for records in record_sets
+                    for folder_path, _ in records}
+    folder_ids = {}
+
+    for folder_path in sorted(folder_paths):
+        folder = get_or_create_folder(folder_path)
+        folder_ids[folder_path] = folder.id if folder else None
+
+    return folder_ids
+
+
+def prepare_domain_ids(delta):
+    """
+    Get IDs for the domains which a Delta refers to.
+
+    Domains are validated and inserted as one batch.
+
+    :return: 2-tuple of domain_ids and report.
+        domain_ids: dict of Domain IDs for each URL which has a valid domain.
+        report: ValidationReport listing the URLs which do not have a valid
+            domain, without an index since a URL may be in many folders.
+    """
+    urls = sorted({url for items in delta for (_, url), *_ in items})
+    domain_values = [convert.split_url(url)[0] for url in urls]
+
+    domain_report = validators.ValidationReport()
+    valid_values = validators.validate_domains(domain_values, domain_report)
+    # Report the URL as given, rather than the domain split from it.
+    report = validators.ValidationReport()
+    for _, index, _, message in domain_report.errors:
+        report.add('url', None, urls[index], message)
+    ids = bulk_insert_domains(v for v in valid_values if v is not None)
+    domain_ids = {url: ids[value] for url, value in zip(urls, valid_values)
+                  if value is not None}
+
+    return domain_ids, report
+
+
+def apply_delta(delta, source_id, domain_ids):
+    """
+    Apply a Delta to the Page rows of a Source, in one transaction.
+
+    Rows are written with plain SQL to the source's page table, which is in
+    its shard if the source is sharded. Labels, clusters and blob links of
+    removed pages are removed too.
+
+    A page which is moved into a folder which already has a row for the same
+    URL, such as from another source, is removed instead.
+
+    :param delta: Delta of resolved records, as from diff.
+    :param domain_ids: dict of Domain IDs by URL, as from prepare_domain_ids.
+        URLs which are not in it are skipped.
+
+    :return: Delta of counts of rows added, removed, moved and retitled.
+    """
+    table = shards.page_table(source_id)
+    match = ("source_id = ? AND domain_id = ? AND path = ?"
+             " AND folder_id IS ?")
+
+    def _where(folder_id, url):
+        return (source_id, domain_ids[url], convert.split_url(url)[1],
+                folder_id)
+
+    added = []
+    for (folder_id, url), url_data in delta.added:
+        if url not in domain_ids:
+            continue
+        created_at = datetime.datetime.strptime(url_data['date_added'],
+                                                convert.DATETIME_FORMAT)
+        added.append((domain_ids[url], convert.split_url(url)[1],
+                      url_data['title'],
+                      created_at.strftime(DATETIME_FORMAT),
+                      folder_id, source_id))
+
+    removed = [_where(folder_id, url)
+               for (folder_id, url), _ in delta.removed
+               if url in domain_ids]
+    moved = [((folder_id, url_data['title']), _where(old_folder_id, url))
+             for (folder_id, url), url_data, old_folder_id in delta.moved
+             if url in domain_ids]
+    retitled = [(url_data['title'],) + _where(folder_id, url)
+                for (folder_id, url), url_data in delta.retitled
+                if url in domain_ids]
+
+    with raw_transaction() as raw_conn:
+        before = raw_conn.total_changes
+        raw_conn.executemany(
+            "INSERT OR IGNORE INTO {} (domain_id, path, title, created_at,"
+            " folder_id, source_id) VALUES (?, ?, ?, ?, ?, ?)".format(table),
+            added
+        )
+        added_count = raw_conn.total_changes - before
+
+        moved_count = 0
+        for values, where in moved:
+            cursor = raw_conn.execute(
+                "UPDATE OR IGNORE {} SET folder_id = ?, title = ? WHERE {}"
+                .format(table, match),
+                values + where
+            )
+            if cursor.rowcount:
+                moved_count += cursor.rowcount
+            else:
+                removed.append(where)
+
+        removed_ids = []
+        for params in removed:
+            removed_ids.extend(row[0] for row in raw_conn.execute(
+                "SELECT id FROM {} WHERE {}".format(table, match), params))
+        raw_conn.executemany("DELETE FROM {} WHERE id = ?".format(table),
+                             ((page_id,) for page_id in removed_ids))
+        for related in (PageLabel, PageCluster, BlobLink):
+            raw_conn.executemany(
+                "DELETE FROM {} WHERE page_id = ?".format(
+                    related.sqlmeta.table),
+                ((page_id,) for page_id in removed_ids)
+            )
+
+        before = raw_conn.total_changes
+        raw_conn.executemany(
+            "UPDATE {} SET title = ? WHERE {}".format(table, match),
+            retitled
+        )
+        retitled_count = raw_conn.total_changes - before
+
+    return Delta(added_count, len(removed_ids), moved_count, retitled_count)
+
+
+def read_tree(path, missing_ok=False):
+    """
+    Read a processed JSON file.
+
+    :param missing_ok: If True, return an empty tree if the file does not
+        exist.
+
+    :raises FileNotFoundError: If the file does not exist and missing_ok is
+        False.
+    """
+    if missing_ok and not os.path.exists(path):
+        return {'folders': {}, 'urls': []}
+
+    with open(path) as f_in:
+        return json.load(f_in)
+
+
+def import_file(processed_path):
+    """
+    Import changes in a processed file since its last import.
+
+    On success, the processed file is copied to the imported directory as
+    the snapshot to compare against next time.
+
+    :raises FileNotFoundError: If the processed file does not exist. This is
+        checked before anything is changed, so a mistyped filename does not
+        remove the source's pages.
+
+    :return: Delta of counts of rows added, removed, moved and retitled.
+    """
+    filename = os.path.basename(processed_path)
+    imported_path = os.path.join(conf.get('text_files', 'imported_dir'),
+                                 filename)
+
+    new_records = flatten(read_tree(processed_path))
+    old_records = flatten(read_tree(imported_path, missing_ok=True))
+
+    source = get_or_create_source(*source_metadata(filename))
+    folder_ids = prepare_folder_ids(old_records, new_records)
+    delta = diff(resolve(old_records, folder_ids),
+                 resolve(new_records, folder_ids))
+    domain_ids, report = prepare_domain_ids(delta)
+    if report:
+        report.print_summary()
+
+    counts = apply_delta(delta, source.id, domain_ids)
+    shutil.copyfile(processed_path, imported_path)
+
+    return counts
+
+
+def main():
+    """
+    Command-line function to import processed files into the database.
+    """
+    parser = argparse.ArgumentParser("Delta importer")
+    parser.add_argument(
+        'FILENAME',
+        nargs='*',
+        help="Names of files in the processed directory. Defaults to all"
+             " files there."
+    )
+    args = parser.parse_args()
+
+    processed_dir = conf.get('text_files', 'processed_dir')
+    if args.FILENAME:
+        paths = [os.path.join(processed_dir, f) for f in args.FILENAME]
+    else:
+        paths = sorted(glob.glob("{}/*.json".format(processed_dir)))
+
+    for path in paths:
+        print("Importing: {}".format(path))
+        counts = import_file(path)
+        print(" added: {0}, removed: {1}, moved: {2}, retitled: {3}".format(
+            *counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Lib hostnames module.
+
+Helpers for the host part of a Domain value, used to group and query domains
+by their subdomain tree or by the site they belong to.
+
+The registrable domain is the public suffix of a host plus one more label,
+such as 'example.co.uk' for 'docs.example.co.uk'. Public suffixes are read
+from a copy of the Public Suffix List if there is one at the configured path,
+otherwise a short built-in list of common suffixes is used. Get the full list
+from:
+    https://publicsuffix.org/list/public_suffix_list.dat
+"""
+import os
+
+from lib.config import AppConf
+
+
+conf = AppConf()
+
+# Used when the full list is not available. Any single-label suffix like
+# 'com' or 'za' is already handled by the default rule.
+BUILTIN_SUFFIXES = [
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'ltd.uk', 'me.uk', 'net.uk',
+    'co.za', 'org.za', 'ac.za', 'gov.za', 'net.za', 'web.za',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'co.nz', 'org.nz', 'ac.nz', 'govt.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp',
+    'com.br', 'com.cn', 'com.mx', 'com.sg', 'com.tr', 'co.in', 'co.kr',
+    'github.io', 'gitlab.io', 'herokuapp.com', 'netlify.app',
+    'blogspot.com', 'appspot.com', 'pages.dev', 'vercel.app',
+]
+
+
+def hostname(domain_value):
+    """
+    Get the hostname from a Domain value, without scheme or port.
+
+    e.g. 'https://docs.python.org:443' gives 'docs.python.org'.
+    """
+    host = domain_value.split('://', 1)[-1]
+
+    return host.rsplit(':', 1)[0] if ':' in host else host
+
+
+def reverse_host(host):
+    """
+    Reverse the labels of a hostname.
+
+    e.g. 'docs.example.co.uk' gives 'uk.co.example.docs'. All subdomains of a
+    host then sort directly after it, so they can be found with a range scan
+    on an index.
+    """
+    return '.'.join(reversed(host.split('.')))
+
+
+def subdomain_range(host):
+    """
+    Get bounds of reversed keys for the subdomains of a host.
+
+    :return: 2-tuple of low and high str values. The keys of all subdomains,
+        but not of the host itself, are greater than low and less than high.
+    """
+    key = reverse_host(host)
+
+    # The '/' character sorts directly after '.'.
+    return key + '.', key + '/'
+
+
+class PublicSuffixList:
+    """
+    Rules from the Public Suffix List, for finding registrable domains.
+
+    Normal, wildcard ('*.ck') and exception ('!www.ck') rules are supported.
+    """
+
+    def __init__(self, rules):
+        """
+        Initialise instance of PublicSuffixList class.
+
+        :param rules: Iterable of rule str values, in the list's format.
+        """
+        self.suffixes = set()
+        self.wildcards = set()
+        self.exceptions = set()
+
+        for rule in rules:
+            rule = rule.strip().lower()
+            if not rule or rule.startswith('//'):
+                continue
+            if rule.startswith('!'):
+                self.exceptions.add(rule[1:])
+            elif rule.startswith('*.'):
+                self.wildcards.add(rule[2:])
+            else:
+                self.suffixes.add(rule)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f_in:
+            # Only the first word on a line is part of the rule.
+            return cls(line.split(' ', 1)[0] for line in f_in)
+
+    def suffix_length(self, labels):
+        """
+        Return the count of labels at the end which are a public suffix.
+        """
+        for i in range(len(labels)):
+            candidate = '.'.join(labels[i:])
+            if candidate in self.exceptions:
+                return len(labels) - i - 1
+            if candidate in self.suffixes:
+                return len(labels) - i
+            if i + 1 < len(labels) and '.'.join(labels[i + 1:]) \
+                    in self.wildcards:
+                return len(labels) - i
+
+        # The default rule is that the last label is a suffix.
+        return 1
+
+    def registrable_domain(self, host):
+        """
+        Return the registrable domain for a host.
+
+        e.g. 'docs.example.co.uk' gives 'example.co.uk'. If the host is
+        itself a public suffix or an IP address, the host is returned.
+        """
+        host = host.lower().rstrip('.')
+        labels = host.split('.')
+
+        if labels[-1].isdigit():
+            return host
+
+        length = self.suffix_length(labels) + 1
+        if length > len(labels):
+            return host
+
+        return '.'.join(labels[-length:])
+
+
+_public_suffixes = None
+
+
+def public_suffixes():
+    """
+    Return the PublicSuffixList for the app, loading it on first use.
+    """
+    global _public_suffixes
+
+    if _public_suffixes is None:
+        path = conf.get('domains', 'public_suffix_path')
+        if os.path.exists(path):
+            _public_suffixes = PublicSuffixList.from_file(path)
+        else:
+            _public_suffixes = PublicSuffixList(BUILTIN_SUFFIXES)
+
+    return _public_suffixes
+
+
+def registrable_domain(host):
+    """
+    Return the registrable domain for a host, using the app's suffix list.
+    """
+    return public_suffixes().registrable_domain(host)
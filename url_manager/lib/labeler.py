@@ -0,0 +1,288 @@
+"""
+Lib labeler module.
+
+Apply labels to all pages in bulk, using rules which match on the domain,
+path prefix or title keywords of a page. See the label rules file in the etc
+directory for the format.
+
+All the rules are compiled into one matcher up front, so each page is checked
+once against all rules rather than once per rule:
+    - Domains go in a trie keyed on hostname labels from the right, so
+      'docs.python.org' is looked up as 'org', 'python', 'docs'.
+    - Path prefixes are looked up in a dict, once for each prefix length.
+    - Title keywords go in an Aho-Corasick automaton, so all keywords are
+      found in a single scan of the title.
+
+Pages are read in chunks ordered by ID and new PageLabel rows are inserted
+in bulk, skipping pairs which exist already.
+
+Usage:
+    $ python -m lib.labeler [--rules PATH]
+"""
+import argparse
+from collections import deque
+from configparser import ConfigParser
+
+from lib.config import AppConf
+from lib.hostnames import hostname
+from lib.database import (bulk_insert_page_labels, get_or_create_label,
+                          iter_page_chunks)
+
+
+conf = AppConf()
+
+
+def _is_word_char(char):
+    """
+    Return True if char is a letter, digit or underscore, as for \\w in a
+    regular expression.
+    """
+    return char.isalnum() or char == '_'
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton for finding many keywords in a text in one pass.
+
+    Keywords only match whole words, so 'go' is found in 'Go tutorial' but
+    not in 'Google Docs'.
+    """
+
+    def __init__(self):
+        # Each state is an index into these lists. State 0 is the root.
+        # Output holds (keyword length, value) pairs, so the start of a
+        # match can be found from where it ends.
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+
+    def add(self, keyword, value):
+        """
+        Add a keyword, with a value to return when it is found.
+        """
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+            state = next_state
+        self.output[state].add((len(keyword), value))
+
+    def build(self):
+        """
+        Set the failure links. Call this after adding all keywords.
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """
+        Return the set of values for all keywords found in the text.
+
+        A match is skipped if it starts or ends inside a word of the text,
+        that is where a word character of the keyword is next to another
+        word character.
+        """
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not output[state]:
+                continue
+            # A keyword which ends here cannot continue a word past the end.
+            if _is_word_char(char) and end + 1 < len(text) \
+                    and _is_word_char(text[end + 1]):
+                continue
+            for length, value in output[state]:
+                start = end - length + 1
+                if start and _is_word_char(text[start]) \
+                        and _is_word_char(text[start - 1]):
+                    continue
+                found.add(value)
+
+        return found
+
+
+class LabelMatcher:
+    """
+    All label rules compiled into one matcher.
+
+    Values added and returned are Label IDs.
+    """
+
+    def __init__(self):
+        self.host_trie = {}
+        self.path_prefixes = {}
+        self.prefix_lengths = []
+        self.keywords = KeywordAutomaton()
+
+    def add_domain(self, pattern, label_id):
+        """
+        Add a hostname, or a "*." pattern for its subdomains.
+        """
+        is_wildcard = pattern.startswith('*.')
+        if is_wildcard:
+            pattern = pattern[2:]
+
+        node = self.host_trie
+        for part in reversed(pattern.lower().split('.')):
+            node = node.setdefault(part, {})
+        key = '*' if is_wildcard else ''
+        node.setdefault(key, set()).add(label_id)
+
+    def add_path(self, prefix, label_id):
+        self.path_prefixes.setdefault(prefix, set()).add(label_id)
+
+    def add_keyword(self, keyword, label_id):
+        self.keywords.add(keyword.lower(), label_id)
+
+    def build(self):
+        """
+        Finish compiling the rules. Call this after adding all rules.
+        """
+        self.prefix_lengths = sorted({len(p) for p in self.path_prefixes})
+        self.keywords.build()
+
+    def match_host(self, host):
+        found = set()
+        node = self.host_trie
+        parts = host.split('.')
+
+        for i in range(len(parts) - 1, -1, -1):
+            node = node.get(parts[i])
+            if node is None:
+                return found
+            # A wildcard only matches if there are labels left of this one.
+            if i and '*' in node:
+                found |= node['*']
+        found |= node.get('', set())
+
+        return found
+
+    def match(self, host, path, title):
+        """
+        Return the set of Label IDs for a page.
+        """
+        found = self.match_host(host)
+
+        for length in self.prefix_lengths:
+            if length > len(path):
+                break
+            labels = self.path_prefixes.get(path[:length])
+            if labels:
+                found |= labels
+
+        if title:
+            found |= self.keywords.search(title.lower())
+
+        return found
+
+
+def _split_option(section, name):
+    return [v.strip() for v in section.get(name, '').split(',') if v.strip()]
+
+
+def load_rules(rules_path):
+    """
+    Read a label rules file and compile it into a LabelMatcher.
+
+    Labels named in the file are created if they do not exist.
+
+    :return: LabelMatcher instance.
+    """
+    rules = ConfigParser(default_section='_unused')
+    with open(rules_path) as f_in:
+        rules.read_file(f_in)
+
+    matcher = LabelMatcher()
+    for label_name in rules.sections():
+        section = rules[label_name]
+        label_id = get_or_create_label(label_name).id
+
+        for pattern in _split_option(section, 'domains'):
+            matcher.add_domain(pattern, label_id)
+        for prefix in _split_option(section, 'paths'):
+            matcher.add_path(prefix, label_id)
+        for keyword in _split_option(section, 'keywords'):
+            matcher.add_keyword(keyword, label_id)
+    matcher.build()
+
+    return matcher
+
+
+def apply_labels(matcher):
+    """
+    Apply labels to all pages which match the rules.
+
+    :return: 2-tuple of count of pages read and count of new PageLabel rows.
+    """
+    page_count = 0
+    inserted = 0
+    host_cache = {}
+
+    for rows in iter_page_chunks():
+        pairs = []
+        for page_id, domain_value, path, title in rows:
+            host = host_cache.get(domain_value)
+            if host is None:
+                host = host_cache[domain_value] = hostname(domain_value)
+            for label_id in matcher.match(host, path, title):
+                pairs.append((page_id, label_id))
+        page_count += len(rows)
+        inserted += bulk_insert_page_labels(pairs)
+
+    return page_count, inserted
+
+
+def run(rules_path=None):
+    """
+    Apply the rules in a label rules file to all pages.
+
+    :param rules_path: Path to the rules file. Defaults to the configured
+        path.
+
+    :return: 2-tuple of count of pages read and count of new PageLabel rows.
+    """
+    matcher = load_rules(rules_path or conf.get('labels', 'rules_path'))
+
+    return apply_labels(matcher)
+
+
+def main():
+    """
+    Command-line function to apply label rules to all pages.
+    """
+    parser = argparse.ArgumentParser("Bulk labeler")
+    parser.add_argument(
+        '--rules',
+        default=conf.get('labels', 'rules_path'),
+        help="Path to a label rules file. Defaults to the configured path."
+    )
+    args = parser.parse_args()
+
+    page_count, inserted = run(args.rules)
+    print("Pages read: {0}. Labels added: {1}.".format(page_count, inserted))
+
+
+if __name__ == '__main__':
+    main()
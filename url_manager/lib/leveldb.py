@@ -0,0 +1,549 @@
+"""
+Lib LevelDB module.
+
+A small, read-only LevelDB reader in pure Python, for getting a single value
+out of a browser's storage directory without native bindings.
+
+The table (.ldb or .sst) and log (.log) files are memory-mapped and read
+directly. No lock is taken on the directory, so this works on a copy of
+the directory or while the browser is running. The files to read are taken
+from the MANIFEST named in CURRENT, so tables which a compaction is still
+writing or is about to delete are left out, and a file which is deleted
+while it is read is skipped. Log records which hold the key are checked
+against their checksums, so a write in progress is skipped and the newest
+complete value is returned.
+
+The value returned for a key is the one with the highest sequence number
+across all files, so it is the newest. If the newest record for the key is
+a deletion, the key is treated as missing.
+
+File formats are described in the LevelDB docs:
+    https://github.com/google/leveldb/blob/main/doc/table_format.md
+    https://github.com/google/leveldb/blob/main/doc/log_format.md
+"""
+import glob
+import mmap
+import os
+import struct
+
+
+TABLE_MAGIC = 0xdb4775248b80fb57
+FOOTER_SIZE = 48
+BLOCK_TRAILER_SIZE = 5
+
+NO_COMPRESSION = 0
+SNAPPY_COMPRESSION = 1
+
+TYPE_DELETION = 0
+TYPE_VALUE = 1
+
+LOG_BLOCK_SIZE = 32768
+LOG_HEADER_SIZE = 7
+LOG_FULL, LOG_FIRST, LOG_MIDDLE, LOG_LAST = 1, 2, 3, 4
+
+# Tags of the fields of a version edit in a MANIFEST file.
+MANIFEST_COMPARATOR = 1
+MANIFEST_LOG_NUMBER = 2
+MANIFEST_NEXT_FILE_NUMBER = 3
+MANIFEST_LAST_SEQUENCE = 4
+MANIFEST_COMPACT_POINTER = 5
+MANIFEST_DELETED_FILE = 6
+MANIFEST_NEW_FILE = 7
+MANIFEST_PREV_LOG_NUMBER = 9
+
+# Times to read the live files if one is removed while it is read.
+READ_ATTEMPTS = 10
+
+
+class LevelDBError(ValueError):
+    """
+    Raised when a LevelDB file cannot be understood.
+    """
+
+
+def read_varint(data, pos):
+    """
+    Read a little-endian base-128 varint.
+
+    :return: 2-tuple of the int value and the position after it.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def snappy_decompress(data):
+    """
+    Decompress a raw Snappy block, as used for LevelDB table blocks.
+
+    See the format description:
+        https://github.com/google/snappy/blob/main/format_description.txt
+    """
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    end = len(data)
+
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        element_type = tag & 0x03
+
+        if element_type == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[pos:pos + extra], 'little')
+                pos += extra
+            size += 1
+            out += data[pos:pos + size]
+            pos += size
+            continue
+
+        if element_type == 1:
+            size = ((tag >> 2) & 0x07) + 4
+            offset = ((tag >> 5) << 8) | data[pos]
+            pos += 1
+        elif element_type == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 2], 'little')
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+
+        if offset == 0 or offset > len(out):
+            raise LevelDBError("Invalid Snappy copy offset: {}".format(offset))
+
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            # The copy overlaps the bytes it produces, so repeat the pattern.
+            pattern = out[start:]
+            repeats, remainder = divmod(size, offset)
+            out += pattern * repeats + pattern[:remainder]
+
+    if len(out) != length:
+        raise LevelDBError("Snappy length mismatch: expected {} but got {}"
+                           .format(length, len(out)))
+
+    return bytes(out)
+
+
+def _split_internal_key(internal_key):
+    """
+    Split an internal key into user key, sequence number and value type.
+    """
+    tag = int.from_bytes(internal_key[-8:], 'little')
+
+    return internal_key[:-8], tag >> 8, tag & 0xff
+
+
+def _read_block(data, offset, size):
+    """
+    Read a table block from its handle, decompressing it as needed.
+    """
+    block = data[offset:offset + size]
+    compression = data[offset + size]
+
+    if compression == NO_COMPRESSION:
+        return block
+    if compression == SNAPPY_COMPRESSION:
+        return snappy_decompress(block)
+
+    raise LevelDBError("Unsupported block compression: {}".format(compression))
+
+
+def _iter_block(block):
+    """
+    Iterate over the key and value pairs in a table block.
+    """
+    num_restarts = struct.unpack_from('<I', block, len(block) - 4)[0]
+    end = len(block) - 4 - 4 * num_restarts
+    pos = 0
+    key = b''
+
+    while pos < end:
+        shared, pos = read_varint(block, pos)
+        non_shared, pos = read_varint(block, pos)
+        value_length, pos = read_varint(block, pos)
+        key = key[:shared] + bytes(block[pos:pos + non_shared])
+        pos += non_shared
+        value = block[pos:pos + value_length]
+        pos += value_length
+        yield key, value
+
+
+def search_table(path, key):
+    """
+    Find all records for a key in a table file.
+
+    The index block is used to skip data blocks which cannot hold the key,
+    so only the blocks around it are read.
+
+    :return: list of 3-tuples of sequence number, value type and value.
+    """
+    matches = []
+
+    with open(path, 'rb') as f_in:
+        if os.fstat(f_in.fileno()).st_size < FOOTER_SIZE:
+            return matches
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            footer = data[-FOOTER_SIZE:]
+            magic = struct.unpack_from('<Q', footer, FOOTER_SIZE - 8)[0]
+            if magic != TABLE_MAGIC:
+                raise LevelDBError("Not a LevelDB table file: {}".format(path))
+
+            # Skip the metaindex handle to get to the index handle.
+            _, pos = read_varint(footer, 0)
+            _, pos = read_varint(footer, pos)
+            index_offset, pos = read_varint(footer, pos)
+            index_size, pos = read_varint(footer, pos)
+            index_block = _read_block(data, index_offset, index_size)
+
+            for separator, handle in _iter_block(index_block):
+                # Every key in a data block sorts at or before its separator.
+                if _split_internal_key(separator)[0] < key:
+                    continue
+
+                block_offset, handle_pos = read_varint(handle, 0)
+                block_size, _ = read_varint(handle, handle_pos)
+                block = _read_block(data, block_offset, block_size)
+
+                for internal_key, value in _iter_block(block):
+                    user_key, sequence, value_type = \
+                        _split_internal_key(internal_key)
+                    if user_key == key:
+                        matches.append((sequence, value_type, bytes(value)))
+                    elif user_key > key:
+                        return matches
+
+    return matches
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82f63b78 if crc & 1 else 0)
+        table.append(crc)
+
+    return table
+
+
+CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data, crc=0):
+    """
+    Compute the CRC-32C (Castagnoli) checksum of bytes.
+    """
+    crc ^= 0xffffffff
+    table = CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+
+    return crc ^ 0xffffffff
+
+
+def _unmask_crc(masked):
+    rotated = (masked - 0xa282ead8) & 0xffffffff
+
+    return ((rotated >> 17) | (rotated << 15)) & 0xffffffff
+
+
+def _iter_log_records(data, key=None):
+    """
+    Iterate over complete records in a log file, joining fragments.
+
+    A record which runs past the end of the file, because it is still being
+    written, is dropped. So is a record with a fragment which fails its
+    checksum. The rest of a block is skipped where a fragment's length does
+    not fit in it, since its header cannot be trusted.
+
+    :param key: Optional bytes string. If set, only records which contain it
+        are returned, and only their checksums are verified. Checking every
+        record of a log of a few MB in pure Python takes about a second.
+    """
+    pos = 0
+    end = len(data)
+    # Fragments of the record being joined, as 3-tuples of masked checksum,
+    # start position and length, or None between records.
+    fragments = None
+
+    while pos + LOG_HEADER_SIZE <= end:
+        block_remaining = LOG_BLOCK_SIZE - pos % LOG_BLOCK_SIZE
+        if block_remaining < LOG_HEADER_SIZE:
+            # Trailing bytes of a block are zero padding.
+            pos += block_remaining
+            continue
+
+        masked_crc, length, record_type = struct.unpack_from('<IHB', data,
+                                                             pos)
+        if record_type == 0 and length == 0:
+            # Preallocated space which has not been written to yet.
+            pos += block_remaining
+            continue
+        payload_start = pos + LOG_HEADER_SIZE
+        if payload_start + length > end:
+            # The last record is only partly written.
+            return
+        if length > block_remaining - LOG_HEADER_SIZE:
+            fragments = None
+            pos += block_remaining
+            continue
+        pos = payload_start + length
+        fragment = (masked_crc, payload_start, length)
+
+        if record_type in (LOG_FULL, LOG_FIRST):
+            fragments = [fragment]
+        elif fragments is None:
+            # The start of this record was dropped.
+            continue
+        elif record_type in (LOG_MIDDLE, LOG_LAST):
+            fragments.append(fragment)
+        else:
+            fragments = None
+            continue
+        if record_type in (LOG_FIRST, LOG_MIDDLE):
+            continue
+
+        record = b''.join(data[start:start + size]
+                          for _, start, size in fragments)
+        if key is not None and key not in record:
+            fragments = None
+            continue
+        # The checksum covers the type byte before each payload too.
+        if all(crc32c(data[start - 1:start + size]) == _unmask_crc(masked)
+               for masked, start, size in fragments):
+            yield record
+        fragments = None
+
+
+def search_log(path, key):
+    """
+    Find all records for a key in a log file of write batches.
+
+    :return: list of 3-tuples of sequence number, value type and value.
+    """
+    matches = []
+
+    with open(path, 'rb') as f_in:
+        if os.fstat(f_in.fileno()).st_size == 0:
+            return matches
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for batch in _iter_log_records(data, key):
+                sequence, count = struct.unpack_from('<QI', batch, 0)
+                pos = 12
+                for i in range(count):
+                    value_type = batch[pos]
+                    pos += 1
+                    key_length, pos = read_varint(batch, pos)
+                    record_key = batch[pos:pos + key_length]
+                    pos += key_length
+                    value = b''
+                    if value_type == TYPE_VALUE:
+                        value_length, pos = read_varint(batch, pos)
+                        value = batch[pos:pos + value_length]
+                        pos += value_length
+                    if record_key == key:
+                        matches.append((sequence + i, value_type, value))
+
+    return matches
+
+
+def _read_length_prefixed(data, pos):
+    length, pos = read_varint(data, pos)
+
+    return data[pos:pos + length], pos + length
+
+
+def read_manifest(path):
+    """
+    Read the current set of files from a MANIFEST file.
+
+    The manifest is a log of version edits, which add and delete table
+    files and move on the log number as the database is compacted.
+
+    :return: 3-tuple of the set of table file numbers, the log number and
+        the previous log number. Log files from the log number on, and the
+        one with the previous log number, are still in use.
+    :raises FileNotFoundError: If the manifest does not exist.
+    :raises LevelDBError: If a version edit cannot be understood.
+    """
+    tables = set()
+    log_number = prev_log_number = 0
+
+    with open(path, 'rb') as f_in:
+        data = f_in.read()
+
+    for edit in _iter_log_records(data):
+        pos = 0
+        while pos < len(edit):
+            tag, pos = read_varint(edit, pos)
+            if tag == MANIFEST_COMPARATOR:
+                _, pos = _read_length_prefixed(edit, pos)
+            elif tag == MANIFEST_LOG_NUMBER:
+                log_number, pos = read_varint(edit, pos)
+            elif tag in (MANIFEST_NEXT_FILE_NUMBER, MANIFEST_LAST_SEQUENCE):
+                _, pos = read_varint(edit, pos)
+            elif tag == MANIFEST_COMPACT_POINTER:
+                _, pos = read_varint(edit, pos)
+                _, pos = _read_length_prefixed(edit, pos)
+            elif tag == MANIFEST_DELETED_FILE:
+                level, pos = read_varint(edit, pos)
+                number, pos = read_varint(edit, pos)
+                tables.discard((level, number))
+            elif tag == MANIFEST_NEW_FILE:
+                level, pos = read_varint(edit, pos)
+                number, pos = read_varint(edit, pos)
+                _, pos = read_varint(edit, pos)
+                _, pos = _read_length_prefixed(edit, pos)
+                _, pos = _read_length_prefixed(edit, pos)
+                tables.add((level, number))
+            elif tag == MANIFEST_PREV_LOG_NUMBER:
+                prev_log_number, pos = read_varint(edit, pos)
+            else:
+                raise LevelDBError("Unknown manifest tag {} in {}"
+                                   .format(tag, path))
+
+    return {number for _, number in tables}, log_number, prev_log_number
+
+
+def _file_number(path):
+    try:
+        return int(os.path.splitext(os.path.basename(path))[0])
+    except ValueError:
+        return None
+
+
+def live_files(db_dir):
+    """
+    Get the table and log files which hold the current state of a LevelDB
+    directory.
+
+    The files are taken from the manifest named in CURRENT, so tables which
+    a compaction has written but not yet added, or has replaced but not yet
+    deleted, are left out. Without a CURRENT file, all table and log files
+    in the directory are used.
+
+    :return: 2-tuple of lists of table paths and log paths.
+    :raises FileNotFoundError: If the manifest named in CURRENT does not
+        exist, because it was replaced after CURRENT was read.
+    """
+    try:
+        with open(os.path.join(db_dir, 'CURRENT')) as f_in:
+            manifest_name = f_in.read().strip()
+    except FileNotFoundError:
+        table_paths = [path for pattern in ('*.ldb', '*.sst')
+                       for path in glob.glob(os.path.join(db_dir, pattern))]
+        return table_paths, glob.glob(os.path.join(db_dir, '*.log'))
+
+    table_numbers, log_number, prev_log_number = read_manifest(
+        os.path.join(db_dir, manifest_name))
+
+    table_paths = []
+    for number in sorted(table_numbers):
+        # Older versions of LevelDB name tables with .sst.
+        for extension in ('.ldb', '.sst'):
+            path = os.path.join(db_dir, '{:06d}{}'.format(number, extension))
+            if os.path.exists(path):
+                table_paths.append(path)
+                break
+    log_paths = [path for path in glob.glob(os.path.join(db_dir, '*.log'))
+                 if _file_number(path) is not None and
+                 (_file_number(path) >= log_number or
+                  _file_number(path) == prev_log_number)]
+
+    return table_paths, log_paths
+
+
+def _search_files(paths, key, matches, errors):
+    """
+    Search table and log files for a key, skipping files which cannot be
+    read.
+
+    :param paths: Iterable of paths to table and log files.
+    :param matches: list which records found are added to, as 3-tuples as
+        from search_table.
+    :param errors: list which LevelDBError instances are added to, for files
+        which could not be understood.
+
+    :return: True if every file was read, or False if any was missing.
+    """
+    complete = True
+
+    for path in paths:
+        search = search_log if path.endswith('.log') else search_table
+        try:
+            matches.extend(search(path, key))
+        except FileNotFoundError:
+            # Deleted by a compaction after the list of files was read.
+            complete = False
+        except LevelDBError as e:
+            # Such as a table which a compaction is still writing.
+            errors.append(e)
+
+    return complete
+
+
+def get(db_dir, key):
+    """
+    Get the newest value for a key in a LevelDB directory.
+
+    The directory may be in use, so if a compaction removes a file while it
+    is read, the live files are read again from the manifest and any new
+    ones are searched, up to READ_ATTEMPTS times. Files which cannot be
+    understood are skipped.
+
+    :param db_dir: Path to the LevelDB directory. This can be a copy of the
+        directory.
+    :param key: Key as a bytes string.
+
+    :return: Value as a bytes string, or None if the key is not set.
+    :raises FileNotFoundError: If the directory does not exist.
+    :raises LevelDBError: If the key is not found and a file could not be
+        understood, so it may have held the key.
+    """
+    if not os.path.isdir(db_dir):
+        raise FileNotFoundError("LevelDB directory not found: {}"
+                                .format(db_dir))
+
+    matches = []
+    errors = []
+    searched = set()
+    for _ in range(READ_ATTEMPTS):
+        try:
+            table_paths, log_paths = live_files(db_dir)
+        except FileNotFoundError:
+            # The manifest was replaced after CURRENT was read.
+            continue
+        # Records from files read already are kept, since a compaction only
+        # moves them to newer files, with the same sequence numbers.
+        paths = [path for path in table_paths + log_paths
+                 if path not in searched]
+        searched.update(paths)
+        if _search_files(paths, key, matches, errors):
+            break
+    else:
+        raise LevelDBError("Files changed on every read of {} after {}"
+                           " attempts.".format(db_dir, READ_ATTEMPTS))
+
+    if not matches:
+        if errors:
+            raise errors[0]
+        return None
+
+    _, value_type, value = max(matches, key=lambda match: match[0])
+    if value_type == TYPE_DELETION:
+        return None
+
+    return value
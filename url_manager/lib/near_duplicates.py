@@ -0,0 +1,213 @@
+"""
+Lib near-duplicates module.
+
+Find clusters of pages which are probably the same page saved more than once,
+such as an article with different query strings, an AMP version of it, or
+a slightly different title. Clusters are written to the PageCluster table.
+
+Each page is turned into a set of shingles from its normalised URL path and
+its title. A MinHash signature estimates how similar two sets are, and
+Locality-Sensitive Hashing (LSH) splits the signature into bands so that
+only pages which share a whole band are compared. This keeps the work
+roughly linear in the count of pages, instead of comparing every pair.
+
+Usage:
+    $ python -m lib.near_duplicates [--threshold 0.7]
+"""
+import argparse
+import random
+import re
+import zlib
+from array import array
+
+from lib.database import PageCluster, iter_page_chunks, raw_transaction
+from lib.hostnames import hostname
+
+
+# Signature length, split into bands of rows. A pair of pages with a
+# similarity of s shares at least one band with probability
+# 1 - (1 - s ** ROWS) ** BANDS, which is about 0.5 at s = 0.5 and above 0.99
+# at s = 0.8.
+BANDS = 16
+ROWS = 4
+NUM_PERM = BANDS * ROWS
+
+# Hashes are kept to 32 bits, so signatures fit in an unsigned int array.
+MAX_HASH = (1 << 32) - 1
+PRIME = (1 << 61) - 1
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Path words which do not say anything about which page it is.
+IGNORED_WORDS = {'amp', 'www', 'index', 'html', 'htm', 'php', 'aspx', 'm'}
+
+
+def _permutations(seed=1):
+    rnd = random.Random(seed)
+
+    return [(rnd.randrange(1, PRIME), rnd.randrange(0, PRIME))
+            for _ in range(NUM_PERM)]
+
+
+PERMUTATIONS = _permutations()
+
+
+def shingles(domain_value, path, title):
+    """
+    Return the set of shingles for a page.
+
+    The host is kept without a leading 'www.', the path is kept without its
+    query string or fragment, and both are split into words. Title words are
+    used alone and in pairs, so that word order counts for something.
+    """
+    host = hostname(domain_value)
+    if host.startswith('www.'):
+        host = host[4:]
+    path = path.split('#', 1)[0].split('?', 1)[0].lower()
+
+    result = {'host:' + host}
+    for word in WORD_PATTERN.findall(path):
+        if word not in IGNORED_WORDS:
+            result.add('path:' + word)
+
+    if title:
+        words = WORD_PATTERN.findall(title.lower())
+        result.update('title:' + w for w in words)
+        result.update('title:{} {}'.format(a, b)
+                      for a, b in zip(words, words[1:]))
+
+    return result
+
+
+def minhash(shingle_set):
+    """
+    Return the MinHash signature of a set of shingles, as a list of ints.
+    """
+    hashes = [zlib.crc32(s.encode('utf-8')) for s in shingle_set]
+
+    return [min(((a * h + b) % PRIME) & MAX_HASH for h in hashes)
+            for a, b in PERMUTATIONS]
+
+
+def similarity(signatures, i, j):
+    """
+    Estimate the similarity of two pages from their signatures.
+    """
+    start_i = i * NUM_PERM
+    start_j = j * NUM_PERM
+    matches = sum(1 for k in range(NUM_PERM)
+                  if signatures[start_i + k] == signatures[start_j + k])
+
+    return matches / NUM_PERM
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+
+    return i
+
+
+def find_clusters(page_ids, signatures, threshold):
+    """
+    Group pages into clusters of near-duplicates.
+
+    For each band, pages are bucketed by the band's values. Within a bucket,
+    each page is compared only with the first page put there, which keeps
+    large buckets from becoming quadratic.
+
+    :param page_ids: array of Page IDs.
+    :param signatures: array of signatures for all pages, one after another.
+    :param threshold: Lowest estimated similarity to count as a duplicate.
+
+    :return: dict where the key is the lowest Page ID in a cluster and
+        the value is a list of Page IDs in that cluster. Only clusters of two
+        or more pages are included.
+    """
+    count = len(page_ids)
+    parents = array('l', range(count))
+
+    for band in range(BANDS):
+        buckets = {}
+        offset = band * ROWS
+        for i in range(count):
+            start = i * NUM_PERM + offset
+            key = hash(tuple(signatures[start:start + ROWS]))
+            first = buckets.setdefault(key, i)
+            if first == i:
+                continue
+            root_i = _find(parents, i)
+            root_first = _find(parents, first)
+            if root_i != root_first and \
+                    similarity(signatures, i, first) >= threshold:
+                parents[max(root_i, root_first)] = min(root_i, root_first)
+
+    members = {}
+    for i in range(count):
+        members.setdefault(_find(parents, i), []).append(page_ids[i])
+
+    return {min(ids): sorted(ids) for ids in members.values() if len(ids) > 1}
+
+
+def write_clusters(clusters):
+    """
+    Replace the rows of the PageCluster table.
+
+    :return: Count of rows written.
+    """
+    table = PageCluster.sqlmeta.table
+    rows = [(page_id, cluster_id) for cluster_id, ids in clusters.items()
+            for page_id in ids]
+
+    with raw_transaction() as raw_conn:
+        raw_conn.execute("DELETE FROM {}".format(table))
+        raw_conn.executemany(
+            "INSERT INTO {} (page_id, cluster) VALUES (?, ?)".format(table),
+            rows
+        )
+
+    return len(rows)
+
+
+def run(threshold=0.7):
+    """
+    Compute signatures for all pages, then find and write clusters.
+
+    :return: dict of clusters, as from find_clusters.
+    """
+    page_ids = array('q')
+    signatures = array('I')
+
+    for rows in iter_page_chunks():
+        for page_id, domain_value, path, title in rows:
+            page_ids.append(page_id)
+            signatures.extend(minhash(shingles(domain_value, path, title)))
+
+    clusters = find_clusters(page_ids, signatures, threshold)
+    write_clusters(clusters)
+
+    return clusters
+
+
+def main():
+    """
+    Command-line function to cluster near-duplicate pages.
+    """
+    parser = argparse.ArgumentParser("Near-duplicate page clustering")
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.7,
+        help="Lowest estimated similarity of two pages for them to be in the"
+             " same cluster, from 0 to 1. Default: %(default)s."
+    )
+    args = parser.parse_args()
+
+    clusters = run(args.threshold)
+    page_count = sum(len(ids) for ids in clusters.values())
+    print("Clusters: {0}. Pages in clusters: {1}.".format(len(clusters),
+                                                        page_count))
+
+
+if __name__ == '__main__':
+    main()
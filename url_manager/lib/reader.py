@@ -0,0 +1,151 @@
+"""
+Lib async reader module.
+
+Serve the common read queries from asyncio code, such as a web UI or search
+service, without going through the single global SQLObject connection.
+
+A pool of read-only SQLite connections is kept and each query runs in a
+thread, so many requests can be waiting on the database at once without
+blocking the event loop. Queries use raw SQL against the same tables which
+the models create, reading pages through the view across all shards.
+
+Usage:
+    >>> async with Reader() as reader:
+    ...     rows = await reader.search('python')
+"""
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
+
+from lib import shards
+from lib.config import AppConf
+
+
+conf = AppConf()
+
+PageRow = namedtuple('PageRow', ['id', 'url', 'title', 'created_at',
+                                 'folder_id'])
+
+PAGE_SELECT = """
+    SELECT page.id, domain.value || page.path, page.title, page.created_at,
+        page.folder_id
+    FROM all_page AS page
+    JOIN domain ON domain.id = page.domain_id
+"""
+
+
+class Reader:
+    """
+    Pool of read-only connections to the configured database.
+
+    Connections are opened when the reader is entered as an async context
+    manager and closed on exit.
+    """
+
+    def __init__(self, db_path=None, pool_size=8):
+        """
+        Initialise instance of Reader class.
+
+        :param db_path: Path to the SQLite file. Defaults to the configured
+            db path.
+        :param pool_size: Count of connections to keep open, which is also
+            the most queries which can run at once.
+        """
+        self.db_path = db_path or conf.get('db', 'path')
+        self.pool_size = pool_size
+        self._pool = None
+        self._executor = None
+
+    def _connect(self):
+        uri = "file:{}?mode=ro".format(pathname2url(self.db_path))
+        return shards.connect(uri, uri=True, check_same_thread=False)
+
+    async def __aenter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        self._pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._pool.put_nowait(self._connect())
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self._executor.shutdown()
+
+    async def fetch_all(self, sql, params=()):
+        """
+        Run a query on a pooled connection and return all rows.
+        """
+        conn = await self._pool.get()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: conn.execute(sql, params).fetchall()
+            )
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def _fetch_pages(self, where, params, limit):
+        sql = "{} WHERE {} ORDER BY page.id LIMIT ?".format(PAGE_SELECT, where)
+        rows = await self.fetch_all(sql, tuple(params) + (limit,))
+
+        return [PageRow(*row) for row in rows]
+
+    async def pages_by_folder(self, folder_id, limit=1000):
+        """
+        Return pages in a folder. Use None for unsorted pages.
+        """
+        if folder_id is None:
+            return await self._fetch_pages("page.folder_id IS NULL", (), limit)
+
+        return await self._fetch_pages("page.folder_id = ?", (folder_id,),
+                                       limit)
+
+    async def pages_by_label(self, name, limit=1000):
+        """
+        Return pages which have a label, looked up by name.
+        """
+        where = """page.id IN (
+            SELECT page_label.page_id
+            FROM page_label
+            JOIN label ON label.id = page_label.label_id
+            WHERE label.name = ?
+        )"""
+
+        return await self._fetch_pages(where, (name,), limit)
+
+    async def pages_by_domain(self, value, limit=1000):
+        """
+        Return pages for a domain value. e.g. 'https://example.com'
+        """
+        return await self._fetch_pages("domain.value = ?", (value,), limit)
+
+    async def search(self, term, limit=100):
+        """
+        Return pages where the term appears in the title or URL, ignoring
+        case. Any % or _ in the term is matched literally.
+        """
+        escaped = term.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+        pattern = "%{}%".format(escaped)
+        where = "page.title LIKE ? ESCAPE '\\'" \
+            " OR domain.value || page.path LIKE ? ESCAPE '\\'"
+
+        return await self._fetch_pages(where, (pattern, pattern), limit)
+
+
+async def test():
+    """
+    Run concurrent searches against the configured database.
+    """
+    async with Reader() as reader:
+        results = await asyncio.gather(*(reader.search('') for _ in range(50)))
+        print("Ran {} searches. Pages in first result: {}".format(
+            len(results), len(results[0])))
+
+
+if __name__ == '__main__':
+    asyncio.run(test())
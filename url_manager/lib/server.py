@@ -0,0 +1,189 @@
+"""
+Lib server module.
+
+A resident process which runs app commands sent by lib.client over a Unix
+domain socket. Running a small command as a new process spends most of its
+time importing SQLObject and FormEncode, reading the conf files and opening
+the database. The server does that once at startup and keeps modules, the
+connection pool and module-level caches such as the public suffix list
+ready for every command after that.
+
+Commands run one at a time, in the order they arrive, with the working
+directory and arguments of the client. Output is sent back to the client as
+it is printed. SQLObject's row cache is cleared before each command, since
+other processes may have changed the database in between.
+
+The conf files are only read at startup, so restart the server after
+changing them.
+
+Usage:
+    $ python -m lib.server [--socket PATH]
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+
+from lib import APP_DIR
+from lib.client import COMMANDS, run_command, socket_path
+
+
+class _SocketStream(io.TextIOBase):
+    """
+    Text stream which sends each write to the client as a message.
+    """
+
+    def __init__(self, wfile, stream_name):
+        super().__init__()
+        self.wfile = wfile
+        self.stream_name = stream_name
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            message = {'stream': self.stream_name, 'text': text}
+            try:
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            except OSError:
+                # The client has gone, but let the command finish.
+                pass
+
+        return len(text)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """
+    Read one command request from a client, run it and reply.
+
+    The request is a JSON object on one line, with command, argv and cwd
+    keys. The reply is a JSON object per line of output, with stream and
+    text keys, followed by a last one with an exit_code key.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # A connection which only checks that the server is up.
+            return
+        request = json.loads(line)
+        name = request['command']
+
+        if name not in COMMANDS:
+            stderr = _SocketStream(self.wfile, 'stderr')
+            stderr.write("Unknown command: {}\n".format(name))
+            exit_code = 2
+        else:
+            exit_code = self.server.run(name, request['argv'],
+                                        request['cwd'], self.wfile)
+
+        try:
+            self.wfile.write(json.dumps({'exit_code': exit_code})
+                             .encode('utf-8') + b'\n')
+        except OSError:
+            pass
+
+
+class CommandServer(socketserver.UnixStreamServer):
+    """
+    Server which keeps the app loaded and runs commands for clients.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise instance of CommandServer class.
+
+        A socket file left by a server which did not shut down cleanly is
+        replaced.
+
+        :param path: Path to create the socket at.
+
+        :raises OSError: If another server is already listening on the path.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                except ConnectionRefusedError:
+                    os.remove(path)
+                else:
+                    raise OSError("A server is already running on {}"
+                                  .format(path))
+
+        super().__init__(path, CommandHandler)
+        # Only the user who runs the server may send it commands.
+        os.chmod(path, 0o600)
+
+    def warm_up(self):
+        """
+        Import the modules of all commands and open a database connection.
+        """
+        # The working directory changes for each command, so imports must
+        # not depend on it.
+        sys.path.insert(0, APP_DIR)
+
+        from lib.database import conn
+        for command in COMMANDS.values():
+            module_name = command.split(':')[0]
+            __import__(module_name)
+        conn.releaseConnection(conn.getConnection())
+
+    def run(self, name, argv, cwd, wfile):
+        """
+        Run a command in the client's working directory.
+
+        :return: Exit code of the command, as int.
+        """
+        from lib.database import conn
+        conn.cache.clear()
+
+        old_cwd = os.getcwd()
+        os.chdir(cwd)
+        try:
+            return run_command(name, argv,
+                               stdout=_SocketStream(wfile, 'stdout'),
+                               stderr=_SocketStream(wfile, 'stderr'))
+        finally:
+            os.chdir(old_cwd)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    """
+    Command-line function to run the server until interrupted.
+    """
+    parser = argparse.ArgumentParser("Command server")
+    parser.add_argument(
+        '--socket',
+        default=socket_path(),
+        help="Path to the Unix socket to listen on. Default: %(default)s."
+    )
+    args = parser.parse_args()
+
+    # Stop cleanly on kill as well as on Ctrl+C, so the socket is removed.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with CommandServer(args.socket) as server:
+        server.warm_up()
+        print("Listening on: {}".format(args.socket))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    print("Stopped.")
+
+
+if __name__ == '__main__':
+    main()
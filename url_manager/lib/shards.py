@@ -0,0 +1,276 @@
+"""
+Lib shards module.
+
+Keep the Page rows of large sources, such as a big history import, in their
+own SQLite file rather than in the main database file. The main file then
+stays small for vacuum and backup, and a source can be dropped by deleting
+its file.
+
+Sharded sources are listed in the db section of the app conf. Each shard is
+attached to every connection as a schema named like 'shard_3', with a 'page'
+table of the same columns as the main one. A temporary view named 'all_page'
+joins the main and shard page tables with UNION ALL, for reads across all
+pages. Without any shards configured, the view is just the main page table.
+
+Page IDs in a shard start at the source ID shifted left by 40 bits, so they
+never clash with IDs in the main file or other shards.
+
+Writes to a sharded source must go to its shard's table, as given by
+page_table. The Page model itself only reads and writes the main file.
+
+Usage:
+    $ python -m lib.shards --list
+    $ python -m lib.shards --move SOURCE_ID
+    $ python -m lib.shards --drop SOURCE_ID
+"""
+import argparse
+import os
+import sqlite3
+
+from lib.config import AppConf
+
+
+conf = AppConf()
+
+PAGES_VIEW = 'all_page'
+
+ID_SHIFT = 40
+
+# SQLite's default limit on databases attached to one connection.
+MAX_SHARDS = 10
+
+PAGE_COLUMNS = ('id, domain_id, path, title, created_at, image_url,'
+                ' description, folder_id, source_id')
+
+SHARD_PAGE_SQL = """
+    CREATE TABLE IF NOT EXISTS {schema}.page (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        domain_id INT NOT NULL,
+        path TEXT NOT NULL,
+        title TEXT,
+        created_at TIMESTAMP NOT NULL,
+        image_url TEXT,
+        description TEXT,
+        folder_id INT,
+        source_id INT NOT NULL
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS {schema}.page_unique_idx
+        ON page (domain_id, path, folder_id);
+"""
+
+
+def sharded_source_ids():
+    """
+    Return the list of Source IDs configured to be sharded.
+
+    :raises ValueError: If more sources are listed than SQLite can attach
+        to one connection.
+    """
+    value = conf.get('db', 'sharded_sources', fallback='')
+    source_ids = [int(v) for v in value.split(',') if v.strip()]
+
+    if len(source_ids) > MAX_SHARDS:
+        raise ValueError("Too many sharded sources: {} are configured but"
+                         " SQLite can only attach {} databases to a"
+                         " connection. Remove some from sharded_sources in"
+                         " the db section of the conf."
+                         .format(len(source_ids), MAX_SHARDS))
+
+    return source_ids
+
+
+def shard_schema(source_id):
+    return "shard_{:d}".format(source_id)
+
+
+def shard_path(source_id):
+    shard_dir = conf.get('db', 'shard_dir')
+
+    return os.path.join(shard_dir, "source_{:d}.sqlite".format(source_id))
+
+
+def page_table(source_id):
+    """
+    Return the name of the table which holds the pages of a source.
+    """
+    if source_id in sharded_source_ids():
+        return "{}.page".format(shard_schema(source_id))
+
+    return 'page'
+
+
+def attach_shards(raw_conn):
+    """
+    Attach the configured shards to a connection and create the pages view.
+
+    Shard files and their tables are created if they do not exist. This is
+    run by the app's connection for every new DB-API connection. It must not
+    be run inside a transaction.
+
+    :param raw_conn: sqlite3.Connection object.
+
+    :return: None
+    """
+    selects = ["SELECT {} FROM main.page".format(PAGE_COLUMNS)]
+
+    for source_id in sharded_source_ids():
+        path = shard_path(source_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        schema = shard_schema(source_id)
+
+        raw_conn.execute("ATTACH DATABASE ? AS {}".format(schema), (path,))
+        raw_conn.executescript(SHARD_PAGE_SQL.format(schema=schema))
+        # Start new IDs in the shard's own range. This only writes on the
+        # first connection to a new shard.
+        has_sequence = raw_conn.execute(
+            "SELECT 1 FROM {}.sqlite_sequence WHERE name = 'page'"
+            .format(schema)
+        ).fetchone()
+        if not has_sequence:
+            raw_conn.execute(
+                "INSERT INTO {}.sqlite_sequence (name, seq) VALUES ('page', ?)"
+                .format(schema),
+                (source_id << ID_SHIFT,)
+            )
+            raw_conn.commit()
+        selects.append("SELECT {} FROM {}.page".format(PAGE_COLUMNS, schema))
+
+    has_main_page = raw_conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type = 'table'"
+        " AND name = 'page'"
+    ).fetchone()
+    if has_main_page:
+        raw_conn.execute("DROP VIEW IF EXISTS temp.{}".format(PAGES_VIEW))
+        raw_conn.execute("CREATE TEMP VIEW {} AS {}".format(
+            PAGES_VIEW, " UNION ALL ".join(selects)))
+
+
+def connect(db_path=None, **kwargs):
+    """
+    Open a sqlite3 connection with shards attached.
+
+    :param db_path: Path to the main SQLite file. Defaults to the configured
+        db path.
+    :param kwargs: Passed on to sqlite3.connect.
+
+    :return: sqlite3.Connection object.
+    """
+    raw_conn = sqlite3.connect(db_path or conf.get('db', 'path'), **kwargs)
+    attach_shards(raw_conn)
+
+    return raw_conn
+
+
+def move_to_shard(source_id):
+    """
+    Move the pages of a source from the main file to its shard.
+
+    The source must be listed in the configured sharded sources. Page IDs
+    are kept, so labels and clusters still point to the right pages.
+
+    :return: Count of pages moved.
+    """
+    if source_id not in sharded_source_ids():
+        raise ValueError("Source {} is not in the configured sharded"
+                         " sources.".format(source_id))
+
+    raw_conn = connect(isolation_level=None)
+    try:
+        raw_conn.execute("BEGIN")
+        cursor = raw_conn.execute(
+            "INSERT INTO {0}.page ({1}) SELECT {1} FROM main.page"
+            " WHERE source_id = ?".format(shard_schema(source_id),
+                                          PAGE_COLUMNS),
+            (source_id,)
+        )
+        moved = cursor.rowcount
+        raw_conn.execute("DELETE FROM main.page WHERE source_id = ?",
+                         (source_id,))
+        raw_conn.execute("COMMIT")
+    finally:
+        raw_conn.close()
+
+    return moved
+
+
+def drop_shard(source_id):
+    """
+    Delete the shard file of a source, along with rows in the main file
+    which point to its pages.
+
+    Remove the source from the configured sharded sources afterwards, or
+    the shard will be created again empty on the next connection.
+
+    :return: None
+    """
+    path = shard_path(source_id)
+    low = source_id << ID_SHIFT
+    high = (source_id + 1) << ID_SHIFT
+
+    raw_conn = connect(isolation_level=None)
+    try:
+        page_ids = "SELECT id FROM {}.page".format(shard_schema(source_id))
+        raw_conn.execute("BEGIN")
+        for table in ('page_label', 'page_cluster', 'blob_link'):
+            raw_conn.execute(
+                "DELETE FROM main.{0} WHERE page_id IN ({1})"
+                " OR (page_id >= ? AND page_id < ?)".format(table, page_ids),
+                (low, high)
+            )
+        raw_conn.execute("COMMIT")
+    finally:
+        raw_conn.close()
+
+    os.remove(path)
+
+
+def main():
+    """
+    Command-line function to list, move or drop shards.
+    """
+    parser = argparse.ArgumentParser("Source shards")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        '--list',
+        action='store_true',
+        help="Show page counts for the main file and each shard."
+    )
+    group.add_argument(
+        '--move',
+        metavar='SOURCE_ID',
+        type=int,
+        help="Move pages for a sharded source out of the main file."
+    )
+    group.add_argument(
+        '--drop',
+        metavar='SOURCE_ID',
+        type=int,
+        help="Delete the shard file for a source and its labels and"
+             " clusters and blob links."
+    )
+    args = parser.parse_args()
+
+    if args.move is not None:
+        print("Moved pages: {}".format(move_to_shard(args.move)))
+    elif args.drop is not None:
+        drop_shard(args.drop)
+        print("Dropped shard: {}".format(shard_path(args.drop)))
+        print("Remove source {} from the sharded sources in the app conf,"
+              " and its snapshot in the imported directory to import it"
+              " again.".format(args.drop))
+    else:
+        raw_conn = connect()
+        try:
+            count = raw_conn.execute(
+                "SELECT COUNT(*) FROM main.page").fetchone()[0]
+            print("main: {:,d}".format(count))
+            for source_id in sharded_source_ids():
+                count = raw_conn.execute("SELECT COUNT(*) FROM {}".format(
+                    page_table(source_id))).fetchone()[0]
+                print("{}: {:,d}".format(shard_schema(source_id), count))
+        finally:
+            raw_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Lib URL snapshot module.
+
+Load all pages into a compact, read-only, column-based structure for
+analytics and cleanup scripts. This avoids creating a Page object for every
+row and the separate Domain and Folder lookups which Page.get_url does.
+
+Pages are read with Domain in one query. Each column is kept as an array of
+ints, or as a list for text, and domains and folders are interned to small
+integer codes, so that group-by and duplicate checks are simple loops over
+ints.
+
+Usage:
+    $ python -m lib.snapshot
+"""
+import datetime
+from array import array
+from collections import Counter
+
+from lib import shards
+
+
+# Code used in the folder column for pages which are not in a folder.
+NO_FOLDER = -1
+
+PAGES_QUERY = """
+    SELECT page.id, domain.value, page.path, page.title, page.created_at,
+        page.folder_id
+    FROM all_page AS page
+    JOIN domain ON domain.id = page.domain_id
+    ORDER BY page.id
+"""
+
+
+class UrlSnapshot:
+    """
+    Column-based, read-only snapshot of Page data.
+
+    Row i of the snapshot is made up of item i of each column.
+    """
+
+    def __init__(self):
+        """
+        Initialise an empty instance of UrlSnapshot class.
+
+        Use the load method to create a snapshot of the database.
+        """
+        self.ids = array('q')
+        self.domain_codes = array('l')
+        self.folder_codes = array('l')
+        # Date created, as a proleptic Gregorian ordinal.
+        self.dates = array('l')
+        self.paths = []
+        self.titles = []
+
+        # Lookups from code to value. Domains are values like
+        # 'https://example.com', folders are Folder IDs.
+        self.domains = []
+        self.folders = []
+
+    @classmethod
+    def load(cls, db_path=None):
+        """
+        Read all pages from the database into a new snapshot.
+
+        :param db_path: Path to the main SQLite file. Defaults to the
+            configured db path.
+
+        :return: UrlSnapshot instance.
+        """
+        snapshot = cls()
+        domain_lookup = {}
+        folder_lookup = {}
+        date_lookup = {}
+
+        conn = shards.connect(db_path)
+        try:
+            for page_id, domain, path, title, created_at, folder_id \
+                    in conn.execute(PAGES_QUERY):
+                domain_code = domain_lookup.get(domain)
+                if domain_code is None:
+                    domain_code = domain_lookup[domain] = len(snapshot.domains)
+                    snapshot.domains.append(domain)
+
+                if folder_id is None:
+                    folder_code = NO_FOLDER
+                else:
+                    folder_code = folder_lookup.get(folder_id)
+                    if folder_code is None:
+                        folder_code = len(snapshot.folders)
+                        folder_lookup[folder_id] = folder_code
+                        snapshot.folders.append(folder_id)
+
+                # Many pages share a day, so only parse each day once.
+                day = created_at[:10]
+                date = date_lookup.get(day)
+                if date is None:
+                    date = date_lookup[day] = \
+                        datetime.date.fromisoformat(day).toordinal()
+
+                snapshot.ids.append(page_id)
+                snapshot.domain_codes.append(domain_code)
+                snapshot.folder_codes.append(folder_code)
+                snapshot.dates.append(date)
+                snapshot.paths.append(path)
+                snapshot.titles.append(title)
+        finally:
+            conn.close()
+
+        return snapshot
+
+    def __len__(self):
+        return len(self.ids)
+
+    def url(self, index):
+        """
+        Return the full URL for a row.
+        """
+        return self.domains[self.domain_codes[index]] + self.paths[index]
+
+    def count_by_domain(self):
+        """
+        Count pages for each domain.
+
+        :return: Counter where the key is a domain value and the value is
+            the count of pages for that domain.
+        """
+        counts = Counter(self.domain_codes)
+
+        return Counter({self.domains[code]: count
+                        for code, count in counts.items()})
+
+    def count_by_folder(self):
+        """
+        Count pages for each folder.
+
+        :return: Counter where the key is a Folder ID, or None for pages
+            which are not in a folder.
+        """
+        counts = Counter(self.folder_codes)
+
+        return Counter({
+            None if code == NO_FOLDER else self.folders[code]: count
+            for code, count in counts.items()
+        })
+
+    def date_histogram(self, period='month'):
+        """
+        Count pages by the date they were created.
+
+        :param period: One of 'day', 'month' or 'year'.
+
+        :return: dict where the key is a date str such as '2020-01' for
+            a month and the value is a count of pages. Keys are in order.
+        """
+        formats = {'day': "%Y-%m-%d", 'month': "%Y-%m", 'year': "%Y"}
+        date_format = formats[period]
+
+        counts = Counter(self.dates)
+        histogram = Counter()
+        for ordinal, count in counts.items():
+            key = datetime.date.fromordinal(ordinal).strftime(date_format)
+            histogram[key] += count
+
+        return dict(sorted(histogram.items()))
+
+    def duplicates(self):
+        """
+        Find URLs which appear on more than one page, across all folders.
+
+        :return: dict where the key is a URL and the value is a list of
+            Page IDs which have that URL.
+        """
+        rows = {}
+        for index, key in enumerate(zip(self.domain_codes, self.paths)):
+            rows.setdefault(key, []).append(index)
+
+        return {self.url(indexes[0]): [self.ids[i] for i in indexes]
+                for indexes in rows.values() if len(indexes) > 1}
+
+
+def test():
+    """
+    Load a snapshot of the configured database and print a summary.
+    """
+    snapshot = UrlSnapshot.load()
+
+    print("Pages: {}".format(len(snapshot)))
+    print("Domains: {}".format(len(snapshot.domains)))
+    print("Top domains:")
+    for domain, count in snapshot.count_by_domain().most_common(10):
+        print(" {count:7,d} {domain}".format(count=count, domain=domain))
+    print("Pages by year:")
+    for year, count in snapshot.date_histogram('year').items():
+        print(" {year}: {count:,d}".format(year=year, count=count))
+    print("Duplicated URLs: {}".format(len(snapshot.duplicates())))
+
+
+if __name__ == '__main__':
+    test()
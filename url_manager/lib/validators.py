@@ -5,7 +5,9 @@ For more info:
     http://www.formencode.org/en/latest/modules/validators.html#simple-validators
     http://www.formencode.org/en/1.2-branch/Validator.html
 """
-from formencode.validators import Regex
+import re
+
+from formencode.validators import URL, Regex
 
 
 class LowerCaseStr(Regex):
@@ -29,6 +31,115 @@ class LowerCaseStr(Regex):
     }
 
 
+class DomainURL(URL):
+    """
+    Validate the value of a Domain, which is a scheme and host only.
+
+    The value is lowercased on the way in and out of the db, rather than
+    rejected, since hostnames are case insensitive.
+    """
+
+    def _convert_from_python(self, value, state):
+        return value.lower()
+
+    def _convert_to_python(self, value, state):
+        return super()._convert_to_python(value.lower(), state)
+
+
+# Patterns for checking a column of values at once, which is much cheaper than
+# running a FormEncode validator on each value.
+DOMAIN_PATTERN = re.compile(
+    r"^https?://"
+    r"([a-z0-9]([-a-z0-9]*[a-z0-9])?\.)+[a-z0-9]([-a-z0-9]*[a-z0-9])?"
+    r"(:[0-9]{1,5})?$"
+)
+NAME_PATTERN = re.compile(LowerCaseStr.regex)
+
+
+class ValidationReport:
+    """
+    Collect errors found while validating columns of values.
+
+    Each error is a tuple of column name, row index, value and message. The
+    index may be None where the values have no useful position, and is then
+    left out of the summary.
+    """
+
+    def __init__(self, index_name='row'):
+        """
+        Initialise instance of ValidationReport class.
+
+        :param index_name: What the index of an error counts, for the
+            summary. e.g. 'line' if errors are indexed by line number.
+        """
+        self.index_name = index_name
+        self.errors = []
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, column, index, value, message):
+        self.errors.append((column, index, value, message))
+
+    def print_summary(self, limit=10):
+        """
+        Print a count of errors and the first few of them.
+        """
+        print("Validation errors: {}".format(len(self.errors)))
+        for column, index, value, message in self.errors[:limit]:
+            if index is not None:
+                column = "{} {} {}".format(column, self.index_name, index)
+            print(" {column}: {value!r} - {message}".format(
+                column=column, value=value, message=message))
+
+
+def validate_domains(values, report, column='domain'):
+    """
+    Check and normalise a column of Domain values.
+
+    Values are stripped and lowercased, rather than rejected for their case.
+
+    :param values: Iterable of str values such as 'https://Example.com'.
+    :param report: ValidationReport to add errors to.
+    :param column: Name of the column, for the report.
+
+    :return: list of normalised values, with None where a value is invalid.
+    """
+    results = []
+    match = DOMAIN_PATTERN.match
+
+    for index, value in enumerate(values):
+        value = value.strip().lower()
+        if match(value):
+            results.append(value)
+        else:
+            report.add(column, index, value, "Invalid domain URL.")
+            results.append(None)
+
+    return results
+
+
+def validate_names(values, report, column='name'):
+    """
+    Check and normalise a column of names for Browser, Format or Location.
+
+    :return: list of normalised values, with None where a value is invalid.
+    """
+    results = []
+    match = NAME_PATTERN.match
+    message = LowerCaseStr().message('invalid', None)
+
+    for index, value in enumerate(values):
+        value = value.strip().lower()
+        if len(value) >= LowerCaseStr.min and match(value):
+            results.append(value)
+        else:
+            report.add(column, index, value, message)
+            results.append(None)
+
+    return results
+
+
 def test():
     """
     Test function to raise a formencode.Invalid error.
@@ -0,0 +1,396 @@
+"""
+Lib worker module.
+
+A job queue stored in the Task table, with a pool of workers to run tasks in
+the background.
+
+Each worker claims one task at a time inside an immediate transaction, so two
+workers never get the same task. A claim is a lease which the worker keeps
+extending while the task runs. If a worker dies, its lease expires and the
+task is retried like a task which raised an error, so work resumes after
+a crash.
+A task which raises an error is retried after a delay which doubles on each
+attempt, until it runs out of attempts and is marked as failed.
+
+Usage:
+    $ python -m lib.worker --enqueue import \\
+        --args '{"processed_path": "var/lib/processed/bookmarks_chrome_home_personal.json"}'
+    $ python -m lib.worker --concurrency 4
+    $ python -m lib.worker --stats
+"""
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import traceback
+
+from lib.config import AppConf
+from lib.database import DATETIME_FORMAT, Task
+
+
+conf = AppConf()
+
+# Task names mapped to the functions which run them, as "module:function".
+# The function is called with the task's args as keyword arguments.
+TASKS = {
+    'transform': 'transformer:convert_and_write',
+    'transform_file': 'transformer:transform_file',
+    'import': 'lib.delta:import_file',
+    'label': 'lib.labeler:run',
+    'near_duplicates': 'lib.near_duplicates:run',
+    'bulk_import': 'lib.bulk_import:import_file',
+}
+
+LEASE_SECONDS = 300
+RETRY_BASE_SECONDS = 30
+POLL_SECONDS = 1.0
+
+
+def _timestamp(seconds_from_now=0):
+    value = datetime.datetime.now() + \
+        datetime.timedelta(seconds=seconds_from_now)
+
+    return value.strftime(DATETIME_FORMAT)
+
+
+def enqueue(name, args=None, priority=0, max_attempts=3):
+    """
+    Add a task to the queue.
+
+    :param name: Name of the task, which must be a key of TASKS.
+    :param args: dict of keyword arguments for the task function.
+    :param priority: Tasks with a higher priority are run first.
+    :param max_attempts: Count of attempts before the task is failed.
+
+    :return: Task record.
+    """
+    if name not in TASKS:
+        raise ValueError("Unknown task name: {}. Expected one of: {}"
+                         .format(name, ", ".join(sorted(TASKS))))
+
+    return Task(name=name, args=json.dumps(args or {}), priority=priority,
+                max_attempts=max_attempts)
+
+
+def stats():
+    """
+    Return counts of tasks by name and status.
+
+    :return: list of 3-tuples of name, status and count.
+    """
+    return Task._connection.queryAll("""
+        SELECT name, status, COUNT(*)
+        FROM task
+        GROUP BY name, status
+        ORDER BY name, status
+    """)
+
+
+def resolve(name):
+    """
+    Import and return the function for a task name.
+    """
+    module_name, function_name = TASKS[name].split(':')
+    module = importlib.import_module(module_name)
+
+    return getattr(module, function_name)
+
+
+class Worker:
+    """
+    Pool of threads which claim and run tasks from the queue.
+    """
+
+    def __init__(self, concurrency=1, drain=False,
+                 lease_seconds=LEASE_SECONDS):
+        """
+        Initialise instance of Worker class.
+
+        :param concurrency: Count of threads, which is the most tasks which
+            run at once.
+        :param drain: If True, stop once there are no tasks ready to claim,
+            rather than waiting for more.
+        :param lease_seconds: How long a claim lasts without being extended.
+        """
+        self.concurrency = concurrency
+        self.drain = drain
+        self.lease_seconds = lease_seconds
+        self.db_path = conf.get('db', 'path')
+        self.name = "{}:{}".format(socket.gethostname(), os.getpid())
+
+        # Worker name of each running task, by task ID.
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def claim(self, db, worker_name):
+        """
+        Claim the next task which is ready to run.
+
+        A task is ready if it is pending and its run_after time has passed.
+        A running task whose lease has expired is treated as a failed
+        attempt first, since its worker probably died while running it. It
+        is retried after a delay, or failed if it has no attempts left, so
+        a task which keeps killing its worker is not claimed forever.
+
+        :return: 3-tuple of task ID, name and args, or None if there is no
+            task ready.
+        """
+        now = _timestamp()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            expired = db.execute(
+                "SELECT id, attempts, max_attempts FROM task"
+                " WHERE status = 'running' AND lease_expires < ?",
+                (now,)
+            ).fetchall()
+            for task_id, attempts, max_attempts in expired:
+                self._retry_or_fail(db, task_id, attempts, max_attempts,
+                                    "Lease expired before the task finished.")
+
+            row = db.execute(
+                """
+                SELECT id, name, args
+                FROM task
+                WHERE status = 'pending' AND run_after <= ?
+                ORDER BY priority DESC, id
+                LIMIT 1
+                """,
+                (now,)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    """
+                    UPDATE task
+                    SET status = 'running', attempts = attempts + 1,
+                        lease_expires = ?, worker = ?
+                    WHERE id = ?
+                    """,
+                    (_timestamp(self.lease_seconds), worker_name, row[0])
+                )
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+        return row
+
+    def finish(self, db, task_id, worker_name):
+        """
+        Mark a task as done.
+
+        Nothing is changed if another worker has claimed the task since,
+        after this worker's lease expired.
+        """
+        db.execute(
+            "UPDATE task SET status = 'done', finished_at = ?, error = NULL,"
+            " lease_expires = NULL WHERE id = ? AND worker = ?"
+            " AND status = 'running'",
+            (_timestamp(), task_id, worker_name)
+        )
+
+    @staticmethod
+    def _retry_or_fail(db, task_id, attempts, max_attempts, error,
+                       worker_name=None):
+        """
+        Schedule a retry of a task if it has attempts left, or fail it.
+
+        If worker_name is given, the task is only changed if that worker
+        still holds its claim.
+        """
+        condition = "id = ? AND status = 'running'"
+        params = (task_id,)
+        if worker_name is not None:
+            condition += " AND worker = ?"
+            params += (worker_name,)
+
+        if attempts < max_attempts:
+            delay = RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+            db.execute(
+                "UPDATE task SET status = 'pending', run_after = ?, error = ?,"
+                " lease_expires = NULL WHERE {}".format(condition),
+                (_timestamp(delay), error) + params
+            )
+        else:
+            db.execute(
+                "UPDATE task SET status = 'failed', finished_at = ?,"
+                " error = ?, lease_expires = NULL WHERE {}".format(condition),
+                (_timestamp(), error) + params
+            )
+
+    def fail(self, db, task_id, worker_name, error):
+        """
+        Record an error on a task and schedule a retry if it has attempts
+        left.
+
+        Nothing is changed if another worker has claimed the task since,
+        after this worker's lease expired.
+        """
+        attempts, max_attempts = db.execute(
+            "SELECT attempts, max_attempts FROM task WHERE id = ?",
+            (task_id,)
+        ).fetchone()
+        self._retry_or_fail(db, task_id, attempts, max_attempts, error,
+                            worker_name)
+
+    def _extend_leases(self):
+        """
+        Keep extending the leases of running tasks until stopped.
+        """
+        db = self._connect()
+        try:
+            while not self._stopped.wait(self.lease_seconds / 3):
+                with self._lock:
+                    running = list(self._running.items())
+                for task_id, worker_name in running:
+                    db.execute(
+                        "UPDATE task SET lease_expires = ?"
+                        " WHERE id = ? AND worker = ? AND status = 'running'",
+                        (_timestamp(self.lease_seconds), task_id, worker_name)
+                    )
+        finally:
+            db.close()
+
+    def _work(self, index):
+        """
+        Claim and run tasks until stopped, in one thread.
+        """
+        worker_name = "{}:{}".format(self.name, index)
+        db = self._connect()
+        try:
+            while not self._stopped.is_set():
+                task = self.claim(db, worker_name)
+                if task is None:
+                    if self.drain:
+                        return
+                    self._stopped.wait(POLL_SECONDS)
+                    continue
+
+                task_id, name, args = task
+                with self._lock:
+                    self._running[task_id] = worker_name
+                try:
+                    print("Running task {0}: {1}".format(task_id, name))
+                    resolve(name)(**json.loads(args))
+                except Exception:
+                    print("Task {0} failed.".format(task_id))
+                    self.fail(db, task_id, worker_name,
+                              traceback.format_exc())
+                else:
+                    self.finish(db, task_id, worker_name)
+                finally:
+                    with self._lock:
+                        self._running.pop(task_id, None)
+        finally:
+            db.close()
+
+    def run(self):
+        """
+        Run worker threads until interrupted, or until the queue is empty
+        if draining.
+        """
+        heartbeat = threading.Thread(target=self._extend_leases, daemon=True)
+        heartbeat.start()
+
+        threads = [threading.Thread(target=self._work, args=(i,))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            print("Stopping after running tasks finish.")
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+        self._stopped.set()
+
+
+def _run_process(drain):
+    Worker(concurrency=1, drain=drain).run()
+
+
+def run_processes(concurrency, drain=False):
+    """
+    Run one single-threaded Worker in each of a count of processes.
+
+    Use this for tasks which are CPU-bound, since threads in one process
+    cannot run Python code in parallel.
+    """
+    processes = [multiprocessing.Process(target=_run_process, args=(drain,))
+                 for _ in range(concurrency)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def main():
+    """
+    Command-line function to run workers, add a task or show queue stats.
+    """
+    parser = argparse.ArgumentParser("Task worker")
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=1,
+        help="Count of tasks to run at once. Default: %(default)s."
+    )
+    parser.add_argument(
+        '--processes',
+        action='store_true',
+        help="Run tasks in separate processes instead of threads."
+    )
+    parser.add_argument(
+        '--drain',
+        action='store_true',
+        help="Stop once there are no tasks ready to run."
+    )
+    parser.add_argument(
+        '--enqueue',
+        metavar='NAME',
+        choices=sorted(TASKS),
+        help="Add a task to the queue instead of running workers."
+    )
+    parser.add_argument(
+        '--args',
+        default='{}',
+        help="Keyword arguments for an added task, as a JSON object."
+    )
+    parser.add_argument(
+        '--priority',
+        type=int,
+        default=0,
+        help="Priority for an added task. Higher runs first."
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help="Show counts of tasks by name and status."
+    )
+    args = parser.parse_args()
+
+    if args.enqueue:
+        task = enqueue(args.enqueue, json.loads(args.args), args.priority)
+        print("Added task {0}: {1}".format(task.id, task.name))
+    elif args.stats:
+        for name, status, count in stats():
+            print(" {name:20} {status:10} {count:,d}".format(
+                name=name, status=status, count=count))
+    elif args.processes:
+        run_processes(args.concurrency, args.drain)
+    else:
+        Worker(args.concurrency, args.drain).run()
+
+
+if __name__ == '__main__':
+    main()
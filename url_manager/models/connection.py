@@ -3,9 +3,25 @@ Connection module.
 """
 from sqlobject.sqlite import builder
 
+from lib import shards
 from lib.config import AppConf
 
 
+class ShardedSQLiteConnection(builder()):
+    """
+    SQLite connection which attaches any configured page shards.
+
+    SQLObject makes a new DB-API connection per thread, so the shards and the
+    pages view are set up on each one. See lib/shards.py.
+    """
+
+    def makeConnection(self):
+        raw_conn = super().makeConnection()
+        shards.attach_shards(raw_conn)
+
+        return raw_conn
+
+
 def setup_connection():
     """
     Create connection to a database using configured file path.
@@ -16,7 +32,7 @@ def setup_connection():
         model class for it to have access to the DB.
     """
     db_path = AppConf().get('db', 'path')
-    conn = builder()(db_path)
+    conn = ShardedSQLiteConnection(db_path)
 
     return conn
 
@@ -3,16 +3,15 @@
 Model application file.
 
 TODO: Case insensitive uniqueness for path.
-TODO: Validate on domain name that it is lower case. Or to_python is lowercased.
 """
 __all__ = ['Location', 'Format', 'Browser', 'Source', 'Label', 'Folder',
-           'Domain', 'Page', 'PageLabel']
+           'Domain', 'Page', 'PageLabel', 'PageCluster', 'Task', 'Blob',
+           'BlobLink']
 
 
 import sqlobject as so
-from formencode.validators import URL
 
-from lib import validators
+from lib import hostnames, validators
 from models.connection import conn
 
 # Set this here to give all classes a valid _connection attribute for
@@ -32,8 +31,6 @@ class Page(so.SQLObject):
     """
 
     # The host website for the page.
-    # TODO: Ensure this is always converted lowercase rather than raising
-    # an error.
     domain = so.ForeignKey('Domain', notNull=True)
 
     # The location of the webpage relative to the domain.
@@ -69,6 +66,32 @@ class Page(so.SQLObject):
     def get_url(self):
         return "".join((self.domain.value, self.path))
 
+    @classmethod
+    def under_host(cls, host):
+        """
+        Select pages on a host or any of its subdomains.
+
+        Like all Page selects, this only covers pages in the main database
+        file, not those of sharded sources. Use iter_pages in lib.database
+        with host set to include sharded pages.
+        """
+        return cls.select(so.AND(cls.q.domain == Domain.q.id,
+                                 Domain.host_condition(host)))
+
+    @classmethod
+    def for_site(cls, registrable_domain):
+        """
+        Select pages on any host of a site, such as 'example.co.uk'.
+
+        This only covers pages in the main database file, unlike
+        Domain.site_page_counts. Use iter_pages in lib.database with site set
+        to include sharded pages.
+        """
+        return cls.select(so.AND(
+            cls.q.domain == Domain.q.id,
+            Domain.q.registrable_domain == registrable_domain
+        ))
+
 
 class Domain(so.SQLObject):
     """
@@ -80,8 +103,21 @@ class Domain(so.SQLObject):
     class sqlmeta:
         defaultOrder = 'value'
 
-    # Full hostname or domain of the website.
-    value = so.UnicodeCol(alternateID=True, validator=URL)
+    # Full hostname or domain of the website, including the scheme. This is
+    # always lowercased.
+    value = so.UnicodeCol(alternateID=True, validator=validators.DomainURL)
+
+    # Hostname of the value with its labels reversed, such as
+    # 'uk.co.example.docs'. This is set along with value. Subdomains sort
+    # directly after their parent, so a subdomain tree is an indexed range.
+    reversed_host = so.UnicodeCol(default=None)
+    reversed_host_idx = so.DatabaseIndex(reversed_host)
+
+    # The public suffix of the hostname plus one label, such as
+    # 'example.co.uk'. This is set along with value and used to group
+    # domains by site.
+    registrable_domain = so.UnicodeCol(default=None)
+    registrable_domain_idx = so.DatabaseIndex(registrable_domain)
 
     # The date and time when the record was created. Defaults to the
     # current time.
@@ -94,6 +130,57 @@ class Domain(so.SQLObject):
     # for filtering, but slightly more convenient for development.
     pages_list = so.MultipleJoin('Page')
 
+    def _set_value(self, value):
+        self._SO_set_value(value)
+        host = hostnames.hostname(self.value)
+        self.reversed_host = hostnames.reverse_host(host)
+        self.registrable_domain = hostnames.registrable_domain(host)
+
+    @classmethod
+    def host_condition(cls, host):
+        """
+        Return a condition matching a host and all of its subdomains.
+        """
+        low, high = hostnames.subdomain_range(host)
+
+        return so.OR(
+            cls.q.reversed_host == hostnames.reverse_host(host),
+            so.AND(cls.q.reversed_host > low, cls.q.reversed_host < high)
+        )
+
+    @classmethod
+    def subdomains(cls, host):
+        """
+        Select domains for a host and all of its subdomains.
+
+        e.g. 'example.co.uk' matches 'https://example.co.uk' and
+        'https://docs.example.co.uk'.
+        """
+        return cls.select(cls.host_condition(host))
+
+    @classmethod
+    def for_site(cls, registrable_domain):
+        """
+        Select domains of a site, such as 'example.co.uk'.
+        """
+        return cls.selectBy(registrable_domain=registrable_domain)
+
+    @classmethod
+    def site_page_counts(cls):
+        """
+        Count pages for each site.
+
+        :return: list of 2-tuples of registrable domain and page count,
+            with the largest count first.
+        """
+        return cls._connection.queryAll("""
+            SELECT domain.registrable_domain, COUNT(page.id)
+            FROM domain
+            JOIN all_page AS page ON page.domain_id = domain.id
+            GROUP BY domain.registrable_domain
+            ORDER BY COUNT(page.id) DESC
+        """)
+
 
 class Folder(so.SQLObject):
     """
@@ -153,14 +240,118 @@ class PageLabel(so.SQLObject):
     unique_idx = so.DatabaseIndex(page, label, unique=True)
 
 
-# TODO:
-#class Task(so.SQLObject):
-#    """
-#    Model a ...
-#    """
+class PageCluster(so.SQLObject):
+    """
+    Model a page's place in a cluster of near-duplicate pages.
+
+    Rows are replaced each time the near-duplicates job runs, so they can be
+    reviewed or used to merge pages. A page is in at most one cluster and
+    pages which are not near-duplicates of any other page are left out.
+    """
+
+    page = so.ForeignKey('Page', notNull=True, cascade=True)
+    page_idx = so.DatabaseIndex(page, unique=True)
+
+    # ID of the lowest Page ID in the cluster, which is shared by all pages
+    # in the cluster.
+    cluster = so.IntCol(notNull=True)
+    cluster_idx = so.DatabaseIndex(cluster)
+
+
+class Task(so.SQLObject):
+    """
+    Model a background task in the job queue.
+
+    Tasks are added with lib.worker.enqueue and run by the worker command.
+    A worker claims a task by setting it to running with a lease. If the
+    worker dies, the lease expires and another worker can claim the task.
+    A failed task is retried after a delay, until it runs out of attempts.
+    """
+
+    # Name of the task function in the worker's registry. e.g. 'import'
+    name = so.UnicodeCol(notNull=True)
+
+    # Keyword arguments for the task function, as a JSON object.
+    args = so.UnicodeCol(notNull=True, default='{}')
+
+    # One of 'pending', 'running', 'done' or 'failed'.
+    status = so.UnicodeCol(notNull=True, default='pending')
+
+    # Tasks with a higher priority are claimed first.
+    priority = so.IntCol(notNull=True, default=0)
+
+    attempts = so.IntCol(notNull=True, default=0)
+    max_attempts = so.IntCol(notNull=True, default=3)
+
+    # The task may not be claimed before this time. This is pushed back on
+    # each retry.
+    run_after = so.DateTimeCol(notNull=True, default=so.DateTimeCol.now)
+
+    # While running, the time after which the claim lapses. The worker
+    # extends this while the task is still running.
+    lease_expires = so.DateTimeCol(default=None)
+
+    # Identifier of the worker which last claimed the task.
+    worker = so.UnicodeCol(default=None)
+
+    # Error message from the last failed attempt.
+    error = so.UnicodeCol(default=None)
+
+    created_at = so.DateTimeCol(notNull=True, default=so.DateTimeCol.now)
+    finished_at = so.DateTimeCol(default=None)
+
+    claim_idx = so.DatabaseIndex(status, priority, run_after)
+
+
+class Blob(so.SQLObject):
+    """
+    Model a file in the blob store, such as a favicon or a preview image.
+
+    The file is stored once under its SHA-256 hash however many domains or
+    pages use it. See lib.blobs.
+    """
+
+    # Hex digest of the file's content, which is also its name on disk.
+    sha256 = so.UnicodeCol(alternateID=True, length=64)
+
+    # Size in bytes.
+    size = so.IntCol(notNull=True)
+
+    # MIME type as given by the server it was downloaded from.
+    content_type = so.UnicodeCol(default=None)
+
+    created_at = so.DateTimeCol(notNull=True, default=so.DateTimeCol.now)
+
+    # Time the file was last stored or read. The least recently used files
+    # are removed first when the store is over its size limit.
+    last_used = so.DateTimeCol(notNull=True, default=so.DateTimeCol.now)
+    last_used_idx = so.DatabaseIndex(last_used)
+
+
+class BlobLink(so.SQLObject):
+    """
+    Model the use of a Blob by a Domain or a Page.
+
+    One of domain or page is set. A link is removed along with its blob
+    when the blob is removed from the store, so the file can be downloaded
+    again.
+    """
+
+    blob = so.ForeignKey('Blob', notNull=True, cascade=True)
+    blob_idx = so.DatabaseIndex(blob)
+
+    domain = so.ForeignKey('Domain', default=None, cascade=True)
+    domain_idx = so.DatabaseIndex(domain)
+    page = so.ForeignKey('Page', default=None, cascade=True)
+    page_idx = so.DatabaseIndex(page)
 
-#    ...
+    # What the blob is to the domain or page. e.g. 'icon' or 'image'
+    kind = so.UnicodeCol(notNull=True)
 
+    # URL the blob was downloaded from. Other links with the same URL reuse
+    # the blob without downloading it again.
+    url = so.UnicodeCol(notNull=True)
+    url_idx = so.DatabaseIndex(url)
 
 
 # TODO: Move to metadata file.